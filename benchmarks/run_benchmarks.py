@@ -0,0 +1,157 @@
+"""Benchmark pycontextbroker operations against the in-process Orion stand-in.
+
+Measures ops/sec and p50/p99 latency of each operation at several
+concurrency levels, and writes the results as JSON:
+
+    python benchmarks/run_benchmarks.py --latency 0.002 --output bench.json
+    python benchmarks/run_benchmarks.py --baseline bench.json --tolerance 0.2
+
+With ``--baseline`` the run exits with status 1 when an operation got more
+than ``--tolerance`` slower (in ops/sec) than in the baseline results.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from fake_orion import FakeOrionServer  # noqa: E402
+from pycontextbroker.pycontextbroker import ContextBrokerClient  # noqa: E402
+
+BENCH_TYPE = 'Bench'
+
+
+def _entity_id(index):
+    return 'bench_{}'.format(index)
+
+
+def _create(cbc, index):
+    cbc.entity.create(BENCH_TYPE, _entity_id(index), attributes=[{"name": "number", "type": "integer", "value": "0"}])
+
+
+def _get(cbc, index):
+    cbc.entity.get(BENCH_TYPE, _entity_id(index))
+
+
+def _get_value(cbc, index):
+    cbc.attribute.get_value(BENCH_TYPE, _entity_id(index), "number")
+
+
+def _update_value(cbc, index):
+    cbc.attribute.update_value(BENCH_TYPE, _entity_id(index), "number", index)
+
+
+def _delete(cbc, index):
+    cbc.entity.delete(BENCH_TYPE, _entity_id(index))
+
+
+def _subscribe(cbc, index):
+    response = cbc.subscription.on_change(BENCH_TYPE, _entity_id(index), "number", "http://localhost:3030/bench")
+    cbc.subscription.unsubscribe(response['subscribeResponse']['subscriptionId'])
+
+
+# Run in this order: create sets up the entities the others use, delete removes them
+OPERATIONS = [
+    ('create', _create),
+    ('get', _get),
+    ('get_value', _get_value),
+    ('update_value', _update_value),
+    ('subscription', _subscribe),
+    ('delete', _delete),
+]
+
+
+def _percentile(latencies, quantile):
+    return latencies[min(int(quantile * len(latencies)), len(latencies) - 1)]
+
+
+def run_operation(cbc, operation, iterations, concurrency):
+    def timed(index):
+        started = time.perf_counter()
+        operation(cbc, index)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "ops": iterations,
+        "seconds": elapsed,
+        "ops_per_sec": iterations / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000
+    }
+
+
+def run(iterations, concurrency_levels, latency):
+    results = []
+    with FakeOrionServer(latency=latency) as server:
+        for concurrency in concurrency_levels:
+            with ContextBrokerClient(server.ip, server.port, pool_size=max(concurrency, 10)) as cbc:
+                for name, operation in OPERATIONS:
+                    result = run_operation(cbc, operation, iterations, concurrency)
+                    result.update(operation=name, concurrency=concurrency)
+                    results.append(result)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": iterations,
+            "latency": latency,
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        "results": results
+    }
+
+
+def regressions(report, baseline, tolerance):
+    previous = dict(((r['operation'], r['concurrency']), r) for r in baseline['results'])
+    found = []
+    for result in report['results']:
+        before = previous.get((result['operation'], result['concurrency']))
+        if before and result['ops_per_sec'] < before['ops_per_sec'] * (1 - tolerance):
+            found.append({
+                "operation": result['operation'],
+                "concurrency": result['concurrency'],
+                "ops_per_sec": result['ops_per_sec'],
+                "baseline_ops_per_sec": before['ops_per_sec']
+            })
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial broker latency in seconds')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed ops/sec drop against the baseline')
+    args = parser.parse_args()
+
+    report = run(args.iterations, args.concurrency, args.latency)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['regressions'] = regressions(report, json.load(baseline_file), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
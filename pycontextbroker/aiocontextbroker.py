@@ -0,0 +1,444 @@
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from pycontextbroker.cb_attribute import ContextBrokerAttribute
+from pycontextbroker.cb_batch import ContextBrokerBatch
+from pycontextbroker.cb_connection import DEFAULT_HEADERS, compress_body, encode_body
+from pycontextbroker.cb_entity import MAX_QUERY_LIMIT, ContextBrokerEntity
+from pycontextbroker.cb_json import loads
+from pycontextbroker.cb_metrics import ContextBrokerMetrics
+from pycontextbroker.cb_model import Entity
+from pycontextbroker.cb_router import LEAST_OUTSTANDING, ContextBrokerRouter
+from pycontextbroker.cb_stream import CHUNK_SIZE, aiter_array, aiter_paged, aiter_pages, items_from_response
+from pycontextbroker.cb_subscription import DEFAULT_DURATION, DEFAULT_THROTTLING, ContextBrokerSubscription
+from pycontextbroker.cb_version import ContextBrokerVersion
+from pycontextbroker.pycontextbroker import ContextBrokerClient
+
+logger = logging.getLogger(__name__)
+
+
+def request_unsent(error):
+    """True when aiohttp failed to connect, so the request never reached the broker."""
+    return isinstance(error, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ())))
+
+
+class AsyncContextBrokerConnection(object):
+    """Pooled aiohttp session with a bound on the number of in-flight requests.
+
+    The session is created on first use, so the connection can be built
+    outside of a running event loop.
+    """
+
+    def __init__(self, pool_size=100, max_concurrency=100, keep_alive=True, timeout=None, headers=None,
+                 metrics=None, resilience=None, router=None, compress_requests=False):
+        if aiohttp is None:
+            raise ImportError("AsyncContextBrokerClient requires aiohttp, install it with: pip install aiohttp")
+
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.keep_alive = keep_alive
+        self.metrics = metrics
+        self.resilience = resilience
+        self.router = router
+        self.compress_requests = compress_requests
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.headers = dict(DEFAULT_HEADERS)
+        if headers:
+            self.headers.update(headers)
+        self.session = None
+        self.semaphore = None
+
+    def _get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def request(self, method, url, data=None, operation=None, **kwargs):
+        data = encode_body(data)
+        if self.compress_requests:
+            data, headers = compress_body(data, kwargs.get('headers'))
+            if headers:
+                kwargs['headers'] = headers
+        if self.resilience is not None:
+            return await self.resilience.acall(self._send, method, url, data, operation or method, **kwargs)
+        return (await self._send(method, url, data, operation or method, **kwargs))[1]
+
+    async def _send(self, method, url, data, operation, route_key=None, **kwargs):
+        if self.router is not None:
+            return await self.router.asend(self._send_to, method, url, data, operation, route_key,
+                                           (aiohttp.ClientConnectionError, asyncio.TimeoutError), request_unsent,
+                                           **kwargs)
+        return await self._send_to(method, url, data, operation, **kwargs)
+
+    async def _send_to(self, method, url, data, operation, stream=False, **kwargs):
+        session = self._get_session()
+        async with self.semaphore:
+            call = self.metrics.start(operation, method, url, data) if self.metrics is not None else None
+            try:
+                if stream:
+                    # Left unread for the caller, only its announced size is known
+                    response = await session.request(method, url, data=data, **kwargs)
+                    body = None
+                else:
+                    async with session.request(method, url, data=data, **kwargs) as response:
+                        body = await response.read()
+            except Exception as error:
+                if call is not None:
+                    self.metrics.finish(call, error=error)
+                raise
+            if call is not None:
+                response_bytes = len(body) if body is not None else response.content_length or 0
+                self.metrics.finish(call, status=response.status, response_bytes=response_bytes)
+            return response.status, loads(body) if body is not None else response
+
+    async def stream(self, method, url, data=None, operation=None, **kwargs):
+        """Yield the elements of a JSON array response while it is being received.
+
+        Like with the blocking connection, the request goes through the
+        resilience policy (without hedging) and the router, so it is retried
+        or sent to another node until the response starts. Once elements
+        have been handed out it is not.
+        """
+        data = encode_body(data)
+        if self.compress_requests:
+            data, headers = compress_body(data, kwargs.get('headers'))
+            if headers:
+                kwargs['headers'] = headers
+        operation = operation or method
+        if self.resilience is not None:
+            response = await self.resilience.acall(self._send, method, url, data, operation, hedge=False, stream=True,
+                                                   **kwargs)
+        else:
+            response = (await self._send(method, url, data, operation, stream=True, **kwargs))[1]
+
+        try:
+            if response.status != 200:
+                logger.error("Failed to stream Orion Context Broker response: %s", loads(await response.read()))
+                return
+            async for element in aiter_array(response.content.iter_chunked(CHUNK_SIZE)):
+                yield element
+            response.release()
+        finally:
+            # Closes the connection of a response that was not read to the end
+            response.close()
+
+    async def close(self):
+        if self.resilience is not None:
+            self.resilience.close()
+        if self.router is not None:
+            self.router.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncContextBrokerEntity(ContextBrokerEntity):
+    async def create(self, entity_type, entity_id, attributes=None):
+        response = await self.connection.request(*self._create_request(entity_type, entity_id, attributes),
+                                                 route_key=(entity_type, entity_id))
+        self._invalidate(entity_type, entity_id)
+        return response
+
+    async def get(self, entity_type, entity_id):
+        response = self._cached(entity_type, entity_id)
+        if response is not None:
+            return response
+
+        generation = self._generation(entity_type, entity_id)
+        response = await self.connection.request(*self._get_request(entity_type, entity_id))
+        self._remember(entity_type, entity_id, response, generation)
+        return response
+
+    async def get_v2(self, entity_type, entity_id, attrs=None, options=None):
+        return self._entity_from_v2_response(
+            await self.connection.request(*self._get_v2_request(entity_type, entity_id, attrs, options))
+        )
+
+    async def get_entity(self, entity_type, entity_id, attrs=None):
+        if attrs:
+            response = await self.get_v2(entity_type, entity_id, attrs)
+            return Entity.from_response(response) if response is not None else None
+        return Entity.from_response(await self.get(entity_type, entity_id))
+
+    async def get_many(self, entities, attrs=None, chunk_size=100):
+        chunk_size = min(chunk_size, MAX_QUERY_LIMIT)
+        results, missing = self._cached_many(entities, attrs)
+        generations = self._generations(missing)
+        chunks = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+        responses = await asyncio.gather(*[
+            self.connection.request(*self._query_request(keys, attrs)) for keys in chunks
+        ])
+        for keys, response in zip(chunks, responses):
+            results.update(self._query_results(keys, attrs, response, generations))
+        return results
+
+    async def iter(self, entity_type=None, page_size=100, prefetch=True, id_pattern=None, q=None, mq=None, attrs=None,
+                   options=None, stream=False):
+        filters = self._filters(id_pattern, q, mq, attrs, options)
+        if stream:
+            entities = aiter_pages(self.connection, lambda offset: self._list_request(
+                entity_type, page_size, offset, filters), page_size)
+        else:
+            entities = aiter_paged(lambda offset: self._list_page(entity_type, page_size, offset, filters), page_size,
+                                   prefetch)
+        async for entity in entities:
+            yield entity
+
+    async def delete(self, entity_type, entity_id):
+        response = await self.connection.request(*self._delete_request(entity_type, entity_id),
+                                                 route_key=(entity_type, entity_id))
+        self._invalidate(entity_type, entity_id)
+        return response
+
+    async def _list_page(self, entity_type, limit, offset, filters=()):
+        # The total count header is not kept by the asyncio connection, pages end on a short page
+        response = await self.connection.request(*self._list_request(entity_type, limit, offset, filters))
+        return items_from_response(response, 'entities'), None
+
+
+class AsyncContextBrokerAttribute(ContextBrokerAttribute):
+    def __init__(self, cb_address, connection, upsert=False, cache=None, prefer_v2=False, capabilities=None):
+        super(AsyncContextBrokerAttribute, self).__init__(cb_address, connection, upsert=upsert, cache=cache,
+                                                          prefer_v2=prefer_v2, capabilities=capabilities)
+        self.entity = AsyncContextBrokerEntity(cb_address, connection, cache)
+
+    async def get_value(self, entity_type, entity_id, attribute_name):
+        if self._wants_v2() and await self._supports_v2():
+            response = await self.connection.request(*self._get_v2_request(entity_type, entity_id, attribute_name))
+            return self._value_from_v2_response(response, attribute_name)
+
+        attribute = await self.get(entity_type, entity_id, attribute_name)
+        if attribute is None:
+            return None
+
+        return attribute.get('value')
+
+    async def _supports_v2(self):
+        try:
+            return bool(((await self.capabilities()) or {}).get('v2'))
+        except Exception:
+            logger.warning("Failed to look up Orion Context Broker capabilities, reading from NGSIv1", exc_info=True)
+            return False
+
+    async def get(self, entity_type, entity_id, attribute_name):
+        if self.cache is not None:
+            return self._attribute_from_response(await self.entity.get(entity_type, entity_id), attribute_name)
+
+        response = await self.connection.request(*self._get_request(entity_type, entity_id, attribute_name))
+        return self._attribute_from_response(response, attribute_name)
+
+    async def create(self, entity_type, entity_id, attribute_name, attribute_value, attribute_type="integer",
+                     metadatas=None):
+        # Check if entity already exists
+        if not self.upsert and await self.get_value(entity_type, entity_id, attribute_name) is not None:
+            return None
+
+        return await self._write(entity_type, entity_id, self._append_request(
+            entity_type, entity_id, attribute_name, attribute_value, attribute_type, metadatas
+        ))
+
+    async def update(self, entity_type, entity_id, attribute_name, attribute_value=None, metadatas=None):
+        if self.upsert and attribute_value is not None:
+            return await self._upsert(entity_type, entity_id, attribute_name, attribute_value, metadatas)
+
+        # create attribute if it was never created
+        if not self.upsert and attribute_value and await self.get_value(entity_type, entity_id, attribute_name) is None:
+            return await self.create(entity_type, entity_id, attribute_name, attribute_value)
+
+        if attribute_value is None and metadatas is None:
+            return None
+
+        data = self._update_data(attribute_value, metadatas)
+        request = self._update_request(entity_type, entity_id, attribute_name, data)
+        return await self._write(entity_type, entity_id, request)
+
+    async def update_value(self, entity_type, entity_id, attribute_name, attribute_value):
+        if self.upsert:
+            return await self._upsert(entity_type, entity_id, attribute_name, attribute_value)
+
+        # create attribute if it was never created
+        if await self.get_value(entity_type, entity_id, attribute_name) is None:
+            return await self.create(entity_type, entity_id, attribute_name, attribute_value)
+
+        data = {"value": attribute_value}
+        request = self._update_request(entity_type, entity_id, attribute_name, data)
+        return await self._write(entity_type, entity_id, request)
+
+    async def delete(self, entity_type, entity_id, attribute_name):
+        return await self._write(entity_type, entity_id, self._delete_request(entity_type, entity_id, attribute_name))
+
+    async def _upsert(self, entity_type, entity_id, attribute_name, attribute_value, metadatas=None):
+        response = await self._write(entity_type, entity_id, self._upsert_request(
+            entity_type, entity_id, attribute_name, attribute_value, metadatas
+        ))
+        if not self._is_missing(response):
+            return response
+        return await self._write(entity_type, entity_id, self._append_request(
+            entity_type, entity_id, attribute_name, attribute_value, "integer", metadatas
+        ))
+
+    async def _write(self, entity_type, entity_id, request):
+        response = await self.connection.request(*request, route_key=(entity_type, entity_id))
+        self._invalidate(entity_type, entity_id)
+        return response
+
+
+class AsyncContextBrokerSubscription(ContextBrokerSubscription):
+    async def all(self, stream=False):
+        if stream:
+            return self.connection.stream(*self._all_request())
+        return await self.connection.request(*self._all_request())
+
+    async def iter(self, page_size=100, prefetch=True, stream=False):
+        if stream:
+            subscriptions = aiter_pages(self.connection, lambda offset: self._list_request(page_size, offset),
+                                        page_size)
+        else:
+            subscriptions = aiter_paged(lambda offset: self._list_page(page_size, offset), page_size, prefetch)
+        async for subscription in subscriptions:
+            yield subscription
+
+    async def on_change(self, entity_type, entity_id, attribute_name, subscriber_endpoint, duration=DEFAULT_DURATION,
+                        throttling=DEFAULT_THROTTLING):
+        return await self.connection.request(
+            *self._on_change_request(entity_type, entity_id, attribute_name, subscriber_endpoint, duration, throttling)
+        )
+
+    async def on_change_pattern(self, entity_type, id_pattern, attribute_names, subscriber_endpoint,
+                                duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING):
+        return await self.connection.request(
+            *self._pattern_request(entity_type, id_pattern, attribute_names, subscriber_endpoint, duration, throttling)
+        )
+
+    async def on_type_change(self, entity_type, attribute_names, subscriber_endpoint, duration=DEFAULT_DURATION,
+                             throttling=DEFAULT_THROTTLING):
+        return await self.on_change_pattern(entity_type, '.*', attribute_names, subscriber_endpoint, duration,
+                                            throttling)
+
+    async def on_change_many(self, entities, attribute_names, subscriber_endpoint, duration=DEFAULT_DURATION,
+                             throttling=DEFAULT_THROTTLING, chunk_size=100):
+        return list(await asyncio.gather(*[
+            self.connection.request(*request)
+            for request in self._many_requests(entities, attribute_names, subscriber_endpoint, duration, throttling,
+                                               chunk_size)
+        ]))
+
+    async def update(self, subscription_id, duration=None, throttling=None):
+        return await self.connection.request(*self._update_request(subscription_id, duration, throttling))
+
+    async def unsubscribe(self, subscription_id):
+        return await self.connection.request(*self._unsubscribe_request(subscription_id))
+
+    async def _list_page(self, limit, offset):
+        return items_from_response(await self.connection.request(*self._list_request(limit, offset)),
+                                   'subscriptions'), None
+
+
+class AsyncContextBrokerBatch(ContextBrokerBatch):
+    async def update(self, updates, action='APPEND', timeout=None):
+        return [result async for result in self.iter_update(updates, action, timeout)]
+
+    async def append(self, updates):
+        return await self.update(updates, 'APPEND')
+
+    async def delete(self, updates):
+        return await self.update(updates, 'DELETE')
+
+    async def iter_update(self, updates, action='APPEND', timeout=None):
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        for keys, data in self._chunks(updates, action):
+            response = await self.connection.request('POST', self.cb_update_endpoint, data, 'batch.update', **kwargs)
+            self._invalidate(keys)
+            for result in self._results(keys, response):
+                yield result
+
+
+class AsyncContextBrokerClient(object):
+    """asyncio counterpart of ContextBrokerClient.
+
+    Every sub-client coroutine builds the same requests and parses the same
+    responses as its blocking equivalent.
+    """
+
+    def __init__(self, ip, port, pool_size=100, max_concurrency=100, keep_alive=True, timeout=None, headers=None,
+                 attribute_upsert=False, cache=None, metrics=None, resilience=None, nodes=None,
+                 balance=LEAST_OUTSTANDING, pin_writes=False, health_interval=5.0, compress_requests=False,
+                 version_ttl=60, prefer_v2=False):
+        self.cb_address = 'http://{}:{}'.format(ip, port)
+        self.metrics = metrics or ContextBrokerMetrics()
+        self.router = None
+        if nodes:
+            self.router = ContextBrokerRouter([self.cb_address] + list(nodes), balance=balance, pin_writes=pin_writes,
+                                              health_interval=health_interval)
+        self.connection = AsyncContextBrokerConnection(
+            pool_size=pool_size,
+            max_concurrency=max_concurrency,
+            keep_alive=keep_alive,
+            timeout=timeout,
+            headers=headers,
+            metrics=self.metrics,
+            resilience=resilience,
+            router=self.router,
+            compress_requests=compress_requests
+        )
+        self.cache = cache
+        self.version = ContextBrokerVersion(ttl=version_ttl)
+        self.entity = AsyncContextBrokerEntity(self.cb_address, self.connection, cache)
+        self.attribute = AsyncContextBrokerAttribute(self.cb_address, self.connection, upsert=attribute_upsert,
+                                                     cache=cache, prefer_v2=prefer_v2,
+                                                     capabilities=self.get_capabilities)
+        self.subscription = AsyncContextBrokerSubscription(self.cb_address, self.connection)
+        self.batch = AsyncContextBrokerBatch(self.cb_address, self.connection, cache=cache)
+
+    async def close(self):
+        await self.connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def health_check(self, timeout=2.0):
+        try:
+            version_data = await asyncio.wait_for(self.get_version_data(refresh=True), timeout)
+            return bool(version_data.get('orion'))
+        except Exception:
+            logger.exception(
+                "Failed to initialize ContextBroker client: "
+                "connection refused, please check provided IP and PORT"
+            )
+            return False
+
+    # Context Broker
+    async def get_version_data(self, refresh=False):
+        version_data = None if refresh else self.version.cached()
+        if version_data is None:
+            version_data = await self.connection.request('GET', self.cb_address + '/version', operation='version')
+            self.version.store(version_data)
+        return version_data
+
+    async def get_capabilities(self):
+        if self.version.capabilities() is None:
+            try:
+                await self.get_version_data()
+            except Exception:
+                self.version.store(None)
+                raise
+        return self.version.capabilities()
+
+    async def get_orion_version_data(self):
+        return ContextBrokerClient._orion_data(await self.get_version_data(), self.metrics)
+
+    async def get_version(self):
+        return (await self.get_orion_version_data()).get('version')
+
+    async def get_uptime(self):
+        return (await self.get_orion_version_data()).get('uptime')
@@ -1,104 +1,197 @@
-import json
-import requests
+import logging
+from urllib.parse import urlencode
 
+from .cb_connection import ContextBrokerConnection
 from .cb_entity import ContextBrokerEntity
+from .cb_json import dumps, loads
+
+logger = logging.getLogger(__name__)
 
 
 class ContextBrokerAttribute(object):
-    def __init__(self, cb_address):
+    def __init__(self, cb_address, connection=None, upsert=False, cache=None, prefer_v2=False, capabilities=None):
         self.cb_entity_endpoint = cb_address + '/v1/contextEntities'
-        self.entity = ContextBrokerEntity(cb_address)
+        self.cb_entities_endpoint_v2 = cb_address + '/v2/entities'
+        self.connection = connection or ContextBrokerConnection()
+        self.entity = ContextBrokerEntity(cb_address, self.connection, cache)
+        self.cache = cache
+        # When enabled, writes are sent without reading the attribute first: update/update_value PUT the value
+        # (keeping the stored type) and only APPEND it, typed "integer" as without upsert, if it is missing
+        self.upsert = upsert
+        # When enabled and the broker supports it, values are read from NGSIv2 (returned as native JSON types)
+        self.prefer_v2 = prefer_v2
+        self.capabilities = capabilities
 
     def get_value(self, entity_type, entity_id, attribute_name):
-        if self.entity.get(entity_type, entity_id).get('contextElement') is None or \
-           self.entity.get(entity_type, entity_id).get('contextElement').get('attributes') is None:
-            return None
+        if self._wants_v2() and self._supports_v2():
+            request = self._get_v2_request(entity_type, entity_id, attribute_name)
+            response = loads(self.connection.request(*request).content)
+            return self._value_from_v2_response(response, attribute_name)
 
-        response_attributes = self.entity.get(entity_type, entity_id).get('contextElement').get('attributes')
-        attributes = dict([(a.get('name'), a.get('value')) for a in response_attributes])
+        attribute = self.get(entity_type, entity_id, attribute_name)
+        if attribute is None:
+            return None
 
-        return attributes.get(attribute_name)
+        return attribute.get('value')
 
     def get(self, entity_type, entity_id, attribute_name):
-        if self.entity.get(entity_type, entity_id).get('contextElement') is None or \
-                        self.entity.get(entity_type, entity_id).get('contextElement').get('attributes') is None:
-            return None
+        if self.cache is not None:
+            # Read through the cached entity rather than fetching the single attribute
+            return self._attribute_from_response(self.entity.get(entity_type, entity_id), attribute_name)
 
-        response_attributes = self.entity.get(entity_type, entity_id).get('contextElement').get('attributes')
-        for attribute in response_attributes:
-            if attribute.get("name") == attribute_name:
-                return attribute
-
-        return None
+        response = loads(self.connection.request(*self._get_request(entity_type, entity_id, attribute_name)).content)
+        return self._attribute_from_response(response, attribute_name)
 
     def create(self, entity_type, entity_id, attribute_name, attribute_value, attribute_type="integer", metadatas=None):
         # Check if entity already exists
-        if self.get_value(entity_type, entity_id, attribute_name) is not None:
+        if not self.upsert and self.get_value(entity_type, entity_id, attribute_name) is not None:
+            return None
+
+        return self._write(entity_type, entity_id, self._append_request(
+            entity_type, entity_id, attribute_name, attribute_value, attribute_type, metadatas
+        ))
+
+    def update(self, entity_type, entity_id, attribute_name, attribute_value=None, metadatas=None):
+        if self.upsert and attribute_value is not None:
+            return self._upsert(entity_type, entity_id, attribute_name, attribute_value, metadatas)
+
+        # create attribute if it was never created
+        if not self.upsert and attribute_value and self.get_value(entity_type, entity_id, attribute_name) is None:
+            return self.create(entity_type, entity_id, attribute_name, attribute_value)
+
+        if attribute_value is None and metadatas is None:
             return None
 
+        data = self._update_data(attribute_value, metadatas)
+        return self._write(entity_type, entity_id, self._update_request(entity_type, entity_id, attribute_name, data))
+
+    def update_value(self, entity_type, entity_id, attribute_name, attribute_value):
+        if self.upsert:
+            return self._upsert(entity_type, entity_id, attribute_name, attribute_value)
+
+        # create attribute if it was never created
+        if self.get_value(entity_type, entity_id, attribute_name) is None:
+            return self.create(entity_type, entity_id, attribute_name, attribute_value)
+
+        data = {"value": attribute_value}
+        return self._write(entity_type, entity_id, self._update_request(entity_type, entity_id, attribute_name, data))
+
+    def delete(self, entity_type, entity_id, attribute_name):
+        return self._write(entity_type, entity_id, self._delete_request(entity_type, entity_id, attribute_name))
+
+    def _wants_v2(self):
+        # Cached reads are served from the v1 entity, so they stay on v1
+        return self.prefer_v2 and self.capabilities is not None and self.cache is None
+
+    def _supports_v2(self):
+        try:
+            return bool((self.capabilities() or {}).get('v2'))
+        except Exception:
+            logger.warning("Failed to look up Orion Context Broker capabilities, reading from NGSIv1", exc_info=True)
+            return False
+
+    def _upsert(self, entity_type, entity_id, attribute_name, attribute_value, metadatas=None):
+        response = self._write(entity_type, entity_id, self._upsert_request(
+            entity_type, entity_id, attribute_name, attribute_value, metadatas
+        ))
+        if not self._is_missing(response):
+            return response
+        return self._write(entity_type, entity_id, self._append_request(
+            entity_type, entity_id, attribute_name, attribute_value, "integer", metadatas
+        ))
+
+    def _write(self, entity_type, entity_id, request):
+        response = loads(self.connection.request(*request, route_key=(entity_type, entity_id)).content)
+        self._invalidate(entity_type, entity_id)
+        return response
+
+    def _invalidate(self, entity_type, entity_id):
+        if self.cache is not None:
+            self.cache.invalidate(entity_type, entity_id)
+
+    # Requests and responses, shared with the asyncio client
+    def _attribute_endpoint(self, entity_type, entity_id, attribute_name):
+        return '{}/type/{}/id/{}/attributes/{}'.format(
+            self.cb_entity_endpoint,
+            entity_type,
+            entity_id,
+            attribute_name
+        )
+
+    def _get_request(self, entity_type, entity_id, attribute_name):
+        return 'GET', self._attribute_endpoint(entity_type, entity_id, attribute_name), None, 'attribute.get'
+
+    def _get_v2_request(self, entity_type, entity_id, attribute_name):
+        # Projected to the one attribute, without type and metadata: {"id": ..., "type": ..., "<name>": <value>}
+        endpoint = '{}/{}?{}'.format(
+            self.cb_entities_endpoint_v2,
+            entity_id,
+            urlencode([('type', entity_type), ('attrs', attribute_name), ('options', 'keyValues')])
+        )
+        return 'GET', endpoint, None, 'attribute.get_v2'
+
+    def _append_request(self, entity_type, entity_id, attribute_name, attribute_value, attribute_type=None,
+                        metadatas=None):
+        # APPEND creates the attribute (and the entity) if missing, or overwrites it otherwise
         endpoint = '{}/type/{}/id/{}'.format(self.cb_entity_endpoint, entity_type, entity_id)
         attribute_data = {
             "name": attribute_name,
-            "type": attribute_type,
             "value": attribute_value
         }
 
+        if attribute_type:
+            attribute_data['type'] = attribute_type
         if metadatas:
             attribute_data['metadatas'] = metadatas
 
         data = {
             "attributes": [attribute_data]
         }
-        return requests.post(
-            endpoint,
-            data=json.dumps(data),
-            headers={'Content-Type': 'application/json'}
-        ).json()
+        return 'POST', endpoint, dumps(data), 'attribute.append'
 
-    def update(self, entity_type, entity_id, attribute_name, attribute_value=None, metadatas=None):
-        # create attribute if it was never created
-        if self.get_value(entity_type, entity_id, attribute_name) is None and attribute_value:
-            return self.create(entity_type, entity_id, attribute_name, attribute_value)
+    def _update_request(self, entity_type, entity_id, attribute_name, data):
+        return 'PUT', self._attribute_endpoint(entity_type, entity_id, attribute_name), dumps(data), 'attribute.update'
 
-        if attribute_value is None and metadatas is None:
-            return None
+    def _upsert_request(self, entity_type, entity_id, attribute_name, attribute_value, metadatas=None):
+        # No type: an existing attribute keeps its own
+        data = self._update_data(metadatas=metadatas)
+        data["value"] = attribute_value
+        return self._update_request(entity_type, entity_id, attribute_name, data)
+
+    def _delete_request(self, entity_type, entity_id, attribute_name):
+        return 'DELETE', self._attribute_endpoint(entity_type, entity_id, attribute_name), None, 'attribute.delete'
 
+    @staticmethod
+    def _update_data(attribute_value=None, metadatas=None):
         data = {}
         if attribute_value:
             data["value"] = attribute_value
         if metadatas:
             data["metadatas"] = metadatas
+        return data
 
-        endpoint = '{}/type/{}/id/{}/attributes/{}'.format(
-            self.cb_entity_endpoint,
-            entity_type,
-            entity_id,
-            attribute_name
-        )
-        return requests.put(endpoint,
-                            data=json.dumps(data),
-                            headers={'Content-Type': 'application/json'}).json()
+    @staticmethod
+    def _is_missing(response):
+        # A PUT to an unknown entity answers 404, to an unknown attribute of a known entity 472
+        return isinstance(response, dict) and response.get('code') in ('404', '472')
 
-    def update_value(self, entity_type, entity_id, attribute_name, attribute_value):
-        # create attribute if it was never created
-        if self.get_value(entity_type, entity_id, attribute_name) is None:
-            return self.create(entity_type, entity_id, attribute_name, attribute_value)
+    @staticmethod
+    def _value_from_v2_response(response, attribute_name):
+        if not isinstance(response, dict) or 'error' in response:
+            return None
+        return response.get(attribute_name)
+
+    @staticmethod
+    def _attribute_from_response(response, attribute_name):
+        # Works for both attribute responses and whole entity responses
+        response_attributes = response.get('attributes')
+        if response_attributes is None:
+            response_attributes = (response.get('contextElement') or {}).get('attributes')
+        if response_attributes is None:
+            return None
 
-        data = {"value": attribute_value}
-        endpoint = '{}/type/{}/id/{}/attributes/{}'.format(
-            self.cb_entity_endpoint,
-            entity_type,
-            entity_id,
-            attribute_name
-        )
-        return requests.put(endpoint,
-                            data=json.dumps(data),
-                            headers={'Content-Type': 'application/json'}).json()
+        for attribute in response_attributes:
+            if attribute.get("name") == attribute_name:
+                return attribute
 
-    def delete(self, entity_type, entity_id, attribute_name):
-        endpoint = '{}/type/{}/id/{}/attributes/{}'.format(
-            self.cb_entity_endpoint,
-            entity_type,
-            entity_id,
-            attribute_name)
-        return requests.delete(endpoint, headers={'Content-Type': 'application/json'}).json()
+        return None
@@ -0,0 +1,100 @@
+from .cb_connection import ContextBrokerConnection
+from .cb_json import dumps, loads
+
+# Orion rejects request payloads above 1MB by default
+MAX_PAYLOAD_SIZE = 1024 * 1024
+
+
+class ContextBrokerBatch(object):
+    def __init__(self, cb_address, connection=None, chunk_size=100, max_payload_size=MAX_PAYLOAD_SIZE, cache=None):
+        self.cb_update_endpoint = cb_address + '/v1/updateContext'
+        self.connection = connection or ContextBrokerConnection()
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.max_payload_size = max_payload_size
+
+    def update(self, updates, action='APPEND', timeout=None):
+        return list(self.iter_update(updates, action, timeout))
+
+    def append(self, updates):
+        return self.update(updates, 'APPEND')
+
+    def delete(self, updates):
+        return self.update(updates, 'DELETE')
+
+    def iter_update(self, updates, action='APPEND', timeout=None):
+        """Send (entity_type, entity_id, attributes) updates through updateContext.
+
+        ``updates`` may be any iterable, including a generator: it is consumed
+        lazily and only one chunk of serialized context elements is held in
+        memory at a time. Yields one ``{"type", "id", "statusCode"}`` result
+        per entity, in input order. ``timeout`` overrides the connection's.
+        """
+        kwargs = {'timeout': timeout} if timeout is not None else {}
+        for keys, data in self._chunks(updates, action):
+            response = loads(self.connection.request('POST', self.cb_update_endpoint, data, 'batch.update',
+                                                     **kwargs).content)
+            self._invalidate(keys)
+            for result in self._results(keys, response):
+                yield result
+
+    def _invalidate(self, keys):
+        if self.cache is not None:
+            for entity_type, entity_id in keys:
+                self.cache.invalidate(entity_type, entity_id)
+
+    # Requests and responses, shared with the asyncio client
+    def _chunks(self, updates, action):
+        # Elements are serialized one by one and joined into the envelope, so the chunk
+        # size in bytes is known without serializing the whole request again
+        envelope = ('{"contextElements": [', '], "updateAction": "{}"}}'.format(action.upper()))
+        envelope_size = len(envelope[0]) + len(envelope[1])
+        keys, elements, size = [], [], envelope_size
+
+        for entity_type, entity_id, attributes in updates:
+            element = dumps(self._context_element(entity_type, entity_id, attributes))
+            element_size = len(element.encode('utf-8')) + 2
+            if elements and (len(elements) >= self.chunk_size or size + element_size > self.max_payload_size):
+                yield keys, envelope[0] + ', '.join(elements) + envelope[1]
+                keys, elements, size = [], [], envelope_size
+
+            keys.append((entity_type, entity_id))
+            elements.append(element)
+            size += element_size
+
+        if elements:
+            yield keys, envelope[0] + ', '.join(elements) + envelope[1]
+
+    @staticmethod
+    def _results(keys, response):
+        error = response.get('errorCode')
+        context_responses = response.get('contextResponses') or []
+        if len(context_responses) == len(keys):
+            statuses = [r.get('statusCode') for r in context_responses]
+        else:
+            by_key = dict(
+                ((r.get('contextElement', {}).get('type'), r.get('contextElement', {}).get('id')), r.get('statusCode'))
+                for r in context_responses
+            )
+            statuses = [by_key.get(key, error) for key in keys]
+
+        return [
+            {"type": entity_type, "id": entity_id, "statusCode": status or error}
+            for (entity_type, entity_id), status in zip(keys, statuses)
+        ]
+
+    @staticmethod
+    def _context_element(entity_type, entity_id, attributes):
+        element = {
+            "type": entity_type,
+            "isPattern": "false",
+            "id": entity_id
+        }
+
+        if isinstance(attributes, dict):
+            # {"number": 1} shorthand for [{"name": "number", "value": 1}]
+            attributes = [{"name": name, "value": value} for name, value in attributes.items()]
+        if attributes:
+            element["attributes"] = attributes
+
+        return element
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class EntityCache(object):
+    """In-process read-through cache of entity responses keyed by (type, id).
+
+    Entries expire after ``ttl`` seconds (``None`` keeps them until evicted),
+    which can be overridden per entity type with ``type_ttl``. Once
+    ``max_size`` entries are stored the least recently used one is evicted.
+    Cached responses are shared between callers and must not be mutated.
+
+    Every invalidation bumps the generation of its key. A response fetched
+    with the ``generation`` read before the request is not stored if the
+    entity was written to in the meantime, as it may predate that write.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, type_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.type_ttl = type_ttl or {}
+        self.entries = OrderedDict()
+        # key -> generation of its last invalidation, oldest first. Keys dropped from it count as
+        # invalidated at generation_floor, which only makes a set racing with the drop be skipped.
+        self.generations = OrderedDict()
+        self.generation_floor = 0
+        self.last_generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entity_type, entity_id):
+        key = (entity_type, entity_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, entity_type, entity_id):
+        with self.lock:
+            return self.generations.get((entity_type, entity_id), self.generation_floor)
+
+    def set(self, entity_type, entity_id, response, generation=None):
+        ttl = self.type_ttl.get(entity_type, self.ttl)
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        key = (entity_type, entity_id)
+        with self.lock:
+            if generation is not None and self.generations.get(key, self.generation_floor) != generation:
+                return
+            self.entries[key] = (expires_at, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, entity_type, entity_id):
+        key = (entity_type, entity_id)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.last_generation += 1
+            self.generations[key] = self.last_generation
+            self.generations.move_to_end(key)
+            while len(self.generations) > self.max_size:
+                self.generation_floor = self.generations.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+            self.last_generation += 1
+            self.generation_floor = self.last_generation
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def __len__(self):
+        return len(self.entries)
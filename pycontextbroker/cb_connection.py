@@ -0,0 +1,129 @@
+import gzip
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+DEFAULT_HEADERS = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
+# Request bodies smaller than this are sent uncompressed, gzip would not pay for itself
+COMPRESS_MIN_SIZE = 1024
+# Errors after which an idempotent request moves on to the next Orion node
+FAILOVER_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def request_unsent(error):
+    """True when ``error`` was raised before the request reached the broker, so any request may go elsewhere."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class ContextBrokerConnection(object):
+    """Pooled HTTP session shared by every Context Broker sub-client.
+
+    Connections are kept alive between calls, so consecutive requests to
+    Orion reuse the same TCP sockets instead of doing a fresh handshake.
+    Compressed responses are always accepted; ``compress_requests`` also
+    gzips request bodies, for brokers behind a proxy that inflates them.
+    """
+
+    def __init__(self, pool_size=10, keep_alive=True, timeout=None, headers=None, metrics=None, resilience=None,
+                 router=None, compress_requests=False):
+        self.timeout = timeout
+        self.compress_requests = compress_requests
+        self.metrics = metrics
+        self.resilience = resilience
+        self.router = router
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.session.headers.update(DEFAULT_HEADERS)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        if headers:
+            self.session.headers.update(headers)
+
+    def request(self, method, url, data=None, operation=None, **kwargs):
+        data = encode_body(data)
+        if self.compress_requests:
+            data, headers = compress_body(data, kwargs.get('headers'))
+            if headers:
+                kwargs['headers'] = headers
+        if self.resilience is not None:
+            # A streamed response is never hedged, it can't be read twice
+            return self.resilience.call(self._send, method, url, data, operation or method,
+                                        hedge=not kwargs.get('stream'), **kwargs)
+        return self._send(method, url, data, operation or method, **kwargs)[1]
+
+    def _send(self, method, url, data, operation, route_key=None, **kwargs):
+        if self.router is not None:
+            return self.router.send(self._send_to, method, url, data, operation, route_key, FAILOVER_ERRORS,
+                                    request_unsent, **kwargs)
+        return self._send_to(method, url, data, operation, **kwargs)
+
+    def _send_to(self, method, url, data, operation, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.metrics is None:
+            response = self.session.request(method, url, data=data, **kwargs)
+            return response.status_code, response
+
+        call = self.metrics.start(operation, method, url, data)
+        try:
+            response = self.session.request(method, url, data=data, **kwargs)
+        except Exception as error:
+            self.metrics.finish(call, error=error)
+            raise
+        # Streamed bodies are left unread for the caller, only their announced size is known
+        if kwargs.get('stream'):
+            response_bytes = int(response.headers.get('Content-Length') or 0)
+        else:
+            response_bytes = len(response.content)
+        self.metrics.finish(call, status=response.status_code, response_bytes=response_bytes)
+        return response.status_code, response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        if self.resilience is not None:
+            self.resilience.close()
+        if self.router is not None:
+            self.router.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def encode_body(data):
+    """The bytes sent for ``data``, so they are also what the metrics count."""
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+def compress_body(data, headers=None):
+    """Gzip ``data`` if it is worth it, returns the body and headers to send."""
+    if not data or len(data) < COMPRESS_MIN_SIZE:
+        return data, headers
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    headers = dict(headers or {})
+    headers['Content-Encoding'] = 'gzip'
+    return gzip.compress(data), headers
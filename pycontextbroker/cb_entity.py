@@ -1,12 +1,154 @@
-import json
-import requests
+import logging
+from urllib.parse import urlencode
+
+from .cb_connection import ContextBrokerConnection
+from .cb_json import dumps, loads
+from .cb_model import Entity
+from .cb_stream import items_from_response, iter_paged, iter_pages
+
+logger = logging.getLogger(__name__)
+
+# Orion answers at most this many contextResponses per queryContext
+MAX_QUERY_LIMIT = 1000
 
 
 class ContextBrokerEntity(object):
-    def __init__(self, cb_address):
+    def __init__(self, cb_address, connection=None, cache=None):
         self.cb_entity_endpoint = cb_address + '/v1/contextEntities'
+        self.cb_query_endpoint = cb_address + '/v1/queryContext'
+        self.cb_entities_endpoint_v2 = cb_address + '/v2/entities'
+        self.connection = connection or ContextBrokerConnection()
+        self.cache = cache
 
     def create(self, entity_type, entity_id, attributes=None):
+        response = loads(self.connection.request(*self._create_request(entity_type, entity_id, attributes),
+                                                 route_key=(entity_type, entity_id)).content)
+        self._invalidate(entity_type, entity_id)
+        return response
+
+    # Read
+    def get(self, entity_type, entity_id):
+        response = self._cached(entity_type, entity_id)
+        if response is not None:
+            return response
+
+        generation = self._generation(entity_type, entity_id)
+        response = loads(self.connection.request(*self._get_request(entity_type, entity_id)).content)
+        self._remember(entity_type, entity_id, response, generation)
+        return response
+
+    def get_v2(self, entity_type, entity_id, attrs=None, options=None):
+        """Read an entity through NGSIv2, only with the ``attrs`` asked for, None if not found.
+
+        ``options='keyValues'`` drops types and metadata and ``options='values'``
+        returns the bare attribute values, in ``attrs`` order.
+        """
+        response = loads(self.connection.request(*self._get_v2_request(entity_type, entity_id, attrs, options)).content)
+        return self._entity_from_v2_response(response)
+
+    def get_entity(self, entity_type, entity_id, attrs=None):
+        """Typed variant of ``get``: an Entity with O(1) attribute lookup, or None if not found.
+
+        With ``attrs`` only those attributes are transferred, through NGSIv2.
+        """
+        if attrs:
+            response = self.get_v2(entity_type, entity_id, attrs)
+            return Entity.from_response(response) if response is not None else None
+        return Entity.from_response(self.get(entity_type, entity_id))
+
+    def get_many(self, entities, attrs=None, chunk_size=100):
+        """Read many (entity_type, entity_id) pairs with as few queryContext requests as possible.
+
+        Returns a dict keyed by (entity_type, entity_id) holding the same
+        responses as ``get``; entities that do not exist come back with a 404
+        statusCode instead of failing the whole batch. ``chunk_size`` is capped
+        at the 1000 entities Orion returns per queryContext.
+        """
+        chunk_size = min(chunk_size, MAX_QUERY_LIMIT)
+        results, missing = self._cached_many(entities, attrs)
+        generations = self._generations(missing)
+        for start in range(0, len(missing), chunk_size):
+            keys = missing[start:start + chunk_size]
+            response = loads(self.connection.request(*self._query_request(keys, attrs)).content)
+            results.update(self._query_results(keys, attrs, response, generations))
+        return results
+
+    def iter(self, entity_type=None, page_size=100, prefetch=True, id_pattern=None, q=None, mq=None, attrs=None,
+             options=None, stream=False):
+        """Lazily yield every entity (in NGSIv2 format), one page of ``page_size`` at a time.
+
+        With ``prefetch`` the next page is requested in a background thread
+        while the current one is being consumed. ``id_pattern``, ``q`` and
+        ``mq`` filter the entities on the broker, ``attrs`` and ``options``
+        ('keyValues' or 'values') trim what is sent back for each of them.
+        With ``stream`` each page is parsed while it is received and never
+        held in memory as a whole (pages are not prefetched then).
+        """
+        filters = self._filters(id_pattern, q, mq, attrs, options)
+        if stream:
+            for entity in iter_pages(self.connection, lambda offset: self._list_request(
+                    entity_type, page_size, offset, filters), page_size):
+                yield entity
+            return
+
+        for entity in iter_paged(lambda offset: self._list_page(entity_type, page_size, offset, filters), page_size,
+                                 prefetch):
+            yield entity
+
+    # Delete
+    def delete(self, entity_type, entity_id):
+        response = loads(self.connection.request(*self._delete_request(entity_type, entity_id),
+                                                 route_key=(entity_type, entity_id)).content)
+        self._invalidate(entity_type, entity_id)
+        return response
+
+    def _list_page(self, entity_type, limit, offset, filters=()):
+        response = self.connection.request(*self._list_request(entity_type, limit, offset, filters))
+        return items_from_response(loads(response.content), 'entities'), response.headers.get('Fiware-Total-Count')
+
+    # Cache
+    def _cached_many(self, entities, attrs):
+        results, missing, seen = {}, [], set()
+        for key in entities:
+            key = tuple(key)
+            if key in seen:
+                continue
+            seen.add(key)
+            # Projected responses only hold part of the entity, so they bypass the cache
+            response = self._cached(*key) if attrs is None else None
+            if response is not None:
+                results[key] = response
+            else:
+                missing.append(key)
+        return results, missing
+
+    def _cached(self, entity_type, entity_id):
+        if self.cache is None:
+            return None
+        return self.cache.get(entity_type, entity_id)
+
+    def _generation(self, entity_type, entity_id):
+        # Read before sending, so a write landing while the request is in flight keeps its answer out of the cache
+        if self.cache is None:
+            return None
+        return self.cache.generation(entity_type, entity_id)
+
+    def _generations(self, keys):
+        if self.cache is None:
+            return {}
+        return dict((key, self.cache.generation(*key)) for key in keys)
+
+    def _remember(self, entity_type, entity_id, response, generation=None):
+        # Only found entities are cached, so a later create is seen straight away
+        if self.cache is not None and (response.get('statusCode') or {}).get('code') == '200':
+            self.cache.set(entity_type, entity_id, response, generation)
+
+    def _invalidate(self, entity_type, entity_id):
+        if self.cache is not None:
+            self.cache.invalidate(entity_type, entity_id)
+
+    # Requests, shared with the asyncio client
+    def _create_request(self, entity_type, entity_id, attributes=None):
         data = {
             "id": entity_id,
             "type": entity_type
@@ -16,18 +158,87 @@ class ContextBrokerEntity(object):
             # [{"name": "number", "type": "integer", "value": "0", "metadatas": [{"name": "timestamp", "type": "string", "value": "2016-05-30T15:30:00Z"}]}]
             data.update({"attributes": attributes})
 
-        return requests.post(
-            self.cb_entity_endpoint,
-            data=json.dumps(data),
-            headers={'Content-Type': 'application/json'}
-        ).json()
+        return 'POST', self.cb_entity_endpoint, dumps(data), 'entity.create'
 
-    # Read
-    def get(self, entity_type, entity_id):
+    def _get_request(self, entity_type, entity_id):
         endpoint = '{}/type/{}/id/{}'.format(self.cb_entity_endpoint, entity_type, entity_id)
-        return requests.get(endpoint).json()
+        return 'GET', endpoint, None, 'entity.get'
 
-    # Delete
-    def delete(self, entity_type, entity_id):
+    def _delete_request(self, entity_type, entity_id):
         endpoint = '{}/type/{}/id/{}'.format(self.cb_entity_endpoint, entity_type, entity_id)
-        return requests.delete(endpoint).json()
+        return 'DELETE', endpoint, None, 'entity.delete'
+
+    def _query_request(self, keys, attrs=None):
+        data = {
+            "entities": [
+                {"type": entity_type, "isPattern": "false", "id": entity_id} for entity_type, entity_id in keys
+            ]
+        }
+        if attrs:
+            data["attributes"] = list(attrs)
+        # queryContext pages its results (20 by default), ask for the whole chunk at once
+        return 'POST', '{}?limit={}'.format(self.cb_query_endpoint, len(keys)), dumps(data), 'entity.query'
+
+    def _query_results(self, keys, attrs, response, generations=None):
+        error = response.get('errorCode') or {}
+        found = {}
+        for context_response in response.get('contextResponses') or []:
+            element = context_response.get('contextElement') or {}
+            found[(element.get('type'), element.get('id'))] = {
+                "contextElement": element,
+                "statusCode": context_response.get('statusCode')
+            }
+
+        results = {}
+        for entity_type, entity_id in keys:
+            result = found.get((entity_type, entity_id))
+            if result is None:
+                status = error if error.get('code') not in (None, '404') else {
+                    "code": "404",
+                    "reasonPhrase": "No context element found"
+                }
+                result = {
+                    "contextElement": {"type": entity_type, "isPattern": "false", "id": entity_id},
+                    "statusCode": status
+                }
+            elif attrs is None:
+                self._remember(entity_type, entity_id, result, (generations or {}).get((entity_type, entity_id)))
+            results[(entity_type, entity_id)] = result
+        return results
+
+    def _get_v2_request(self, entity_type, entity_id, attrs=None, options=None):
+        params = [('type', entity_type)] + self._filters(attrs=attrs, options=options)
+        endpoint = '{}/{}?{}'.format(self.cb_entities_endpoint_v2, entity_id, urlencode(params))
+        return 'GET', endpoint, None, 'entity.get_v2'
+
+    def _list_request(self, entity_type, limit, offset, filters=()):
+        params = [('limit', limit), ('offset', offset)]
+        if entity_type:
+            params.append(('type', entity_type))
+        # The total count rides along with the output options
+        options = ['count'] + [value for name, value in filters if name == 'options']
+        params += [(name, value) for name, value in filters if name != 'options'] + [('options', ','.join(options))]
+        return 'GET', '{}?{}'.format(self.cb_entities_endpoint_v2, urlencode(params)), None, 'entity.list'
+
+    @staticmethod
+    def _filters(id_pattern=None, q=None, mq=None, attrs=None, options=None):
+        params = []
+        if id_pattern:
+            params.append(('idPattern', id_pattern))
+        if q:
+            params.append(('q', q))
+        if mq:
+            params.append(('mq', mq))
+        if attrs:
+            params.append(('attrs', attrs if isinstance(attrs, str) else ','.join(attrs)))
+        if options:
+            params.append(('options', options))
+        return params
+
+    @staticmethod
+    def _entity_from_v2_response(response):
+        if isinstance(response, dict) and 'error' in response:
+            if response.get('error') != 'NotFound':
+                logger.error("Failed to read Orion Context Broker entity: %s", response)
+            return None
+        return response
@@ -0,0 +1,29 @@
+"""JSON encoding and decoding, using orjson or ujson when one of them is installed."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+
+    def dumps(data):
+        return orjson.dumps(data).decode('utf-8')
+elif ujson is not None:
+    BACKEND = 'ujson'
+    loads = ujson.loads
+
+    def dumps(data):
+        return ujson.dumps(data, escape_forward_slashes=False)
+else:
+    BACKEND = 'json'
+    loads = json.loads
+    dumps = json.dumps
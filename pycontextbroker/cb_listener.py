@@ -0,0 +1,246 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from .cb_json import loads
+
+logger = logging.getLogger(__name__)
+
+
+def parse_notification(notification):
+    """Turn an NGSIv1 or NGSIv2 notification payload into a list of entity updates.
+
+    Each update is a ``{"subscriptionId", "type", "id", "attributes"}`` dict
+    whose attributes use the same ``{"name", "type", "value"}`` shape as the
+    rest of the library.
+    """
+    subscription_id = notification.get('subscriptionId')
+    updates = []
+
+    # NGSIv1: {"subscriptionId": ..., "contextResponses": [{"contextElement": {...}, "statusCode": {...}}]}
+    for context_response in notification.get('contextResponses') or []:
+        element = context_response.get('contextElement') or {}
+        updates.append({
+            "subscriptionId": subscription_id,
+            "type": element.get('type'),
+            "id": element.get('id'),
+            "attributes": element.get('attributes') or []
+        })
+
+    # NGSIv2: {"subscriptionId": ..., "data": [{"id": ..., "type": ..., "<attribute>": {"type", "value", "metadata"}}]}
+    for entity in notification.get('data') or []:
+        attributes = []
+        for name, attribute in entity.items():
+            if name in ('id', 'type'):
+                continue
+            if not isinstance(attribute, dict):
+                # keyValues notifications carry bare values
+                attribute = {"value": attribute}
+            attribute_data = {"name": name, "type": attribute.get('type'), "value": attribute.get('value')}
+            if attribute.get('metadata'):
+                attribute_data['metadatas'] = [
+                    {"name": metadata_name, "type": metadata.get('type'), "value": metadata.get('value')}
+                    for metadata_name, metadata in attribute['metadata'].items()
+                ]
+            attributes.append(attribute_data)
+        updates.append({
+            "subscriptionId": subscription_id,
+            "type": entity.get('type'),
+            "id": entity.get('id'),
+            "attributes": attributes
+        })
+
+    return updates
+
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+    # Keep Orion's connections open between notifications
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            notification = loads(self.rfile.read(length))
+        except ValueError:
+            return self._reply(400)
+        if not isinstance(notification, dict):
+            return self._reply(400)
+
+        accepted = self.server.listener.enqueue(parse_notification(notification))
+        self._reply(200 if accepted else 503)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class _NotificationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class NotificationListener(object):
+    """Local HTTP endpoint receiving Orion notifications for on_change subscriptions.
+
+    Notifications are parsed in the request thread, put on a bounded queue of
+    ``queue_size`` notifications and delivered to registered callbacks by a
+    pool of worker threads. When the queue stays full for ``put_timeout``
+    seconds the notification is answered with a 503 and counted as rejected,
+    so a slow consumer slows the receiver down instead of growing memory
+    without bound. A notification is queued whole or not at all, so one
+    that Orion sends again after a 503 is not delivered twice.
+    """
+
+    def __init__(self, host='0.0.0.0', port=0, public_url=None, workers=4, queue_size=10000, batch_size=1,
+                 batch_interval=0.05, put_timeout=5):
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.callbacks = []
+        self.server = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.received = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+
+    @property
+    def url(self):
+        if self.public_url:
+            return self.public_url
+        host = socket.gethostname() if self.host in ('', '0.0.0.0') else self.host
+        return 'http://{}:{}/notify'.format(host, self.port)
+
+    def on_notification(self, callback, entity_type=None, entity_id=None, batch=False):
+        """Register ``callback`` for updates, optionally filtered by entity type and id.
+
+        Batch callbacks are called with a list of up to ``batch_size`` updates
+        instead of one update at a time.
+        """
+        self.callbacks.append((callback, entity_type, entity_id, batch))
+        return callback
+
+    def subscribe(self, subscription, entity_type, entity_id, attribute_name, **kwargs):
+        # subscription can also be a SubscriptionRegistry, which skips duplicate subscriptions
+        return subscription.on_change(entity_type, entity_id, attribute_name, self.url, **kwargs)
+
+    def start(self):
+        self.server = _NotificationServer((self.host, self.port), _NotificationHandler)
+        self.server.listener = self
+        self.port = self.server.server_address[1]
+
+        self.threads = [threading.Thread(target=self.server.serve_forever)]
+        self.threads += [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop receiving, then let the workers drain what is already queued."""
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def enqueue(self, updates):
+        with self.lock:
+            self.received += len(updates)
+        if not updates:
+            return True
+        try:
+            self.queue.put(updates, timeout=self.put_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += len(updates)
+            logger.warning("Notification queue is full, rejecting notification for %s",
+                           [update.get('id') for update in updates])
+            return False
+
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "received": self.received,
+                "delivered": self.delivered,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "batches": self.batches,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth
+            }
+
+    def _work(self):
+        running = True
+        while running:
+            notification = self.queue.get()
+            if notification is None:
+                break
+
+            updates = list(notification)
+            deadline = time.time() + self.batch_interval
+            while len(updates) < self.batch_size:
+                try:
+                    notification = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if notification is None:
+                    running = False
+                    break
+                updates.extend(notification)
+
+            self._deliver(updates)
+
+    def _deliver(self, updates):
+        for callback, entity_type, entity_id, batch in self.callbacks:
+            matching = [
+                u for u in updates
+                if (entity_type is None or u.get('type') == entity_type) and
+                   (entity_id is None or u.get('id') == entity_id)
+            ]
+            if not matching:
+                continue
+            try:
+                if batch:
+                    callback(matching)
+                else:
+                    for update in matching:
+                        callback(update)
+            except Exception:
+                logger.exception("Notification callback %r failed", callback)
+                with self.lock:
+                    self.errors += 1
+
+        with self.lock:
+            self.delivered += len(updates)
+            self.batches += 1
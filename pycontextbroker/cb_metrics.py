@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class _OperationStats(object):
+    __slots__ = ('count', 'errors', 'in_flight', 'request_bytes', 'response_bytes', 'latency_sum', 'latency_max',
+                 'buckets')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * len(buckets)
+
+
+class ContextBrokerMetrics(object):
+    """Per-operation latency histograms, byte counts, error counts and in-flight gauges.
+
+    Before hooks are called with the call dict (operation, method, url,
+    request_bytes) when a request starts; after hooks get the same dict
+    completed with status, response_bytes, latency and error. Byte counts
+    are of the bodies as sent, UTF-8 encoded and compressed if they were.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.operations = {}
+        self.before_hooks = []
+        self.after_hooks = []
+        self.lock = threading.Lock()
+
+    def add_before_hook(self, hook):
+        self.before_hooks.append(hook)
+        return hook
+
+    def add_after_hook(self, hook):
+        self.after_hooks.append(hook)
+        return hook
+
+    def start(self, operation, method, url, data=None):
+        call = {
+            "operation": operation,
+            "method": method,
+            "url": url,
+            "request_bytes": len(data.encode('utf-8') if isinstance(data, str) else data) if data else 0,
+            "started": time.monotonic()
+        }
+        with self.lock:
+            stats = self._stats(operation)
+            stats.in_flight += 1
+            stats.request_bytes += call["request_bytes"]
+        self._run_hooks(self.before_hooks, call)
+        return call
+
+    def finish(self, call, status=None, response_bytes=0, error=None):
+        latency = time.monotonic() - call["started"]
+        failed = error is not None or (status is not None and status >= 400)
+        call.update(status=status, response_bytes=response_bytes, latency=latency, error=error)
+
+        with self.lock:
+            stats = self._stats(call["operation"])
+            stats.in_flight -= 1
+            stats.count += 1
+            stats.errors += failed
+            stats.response_bytes += response_bytes
+            stats.latency_sum += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            for index, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    stats.buckets[index] += 1
+                    break
+        self._run_hooks(self.after_hooks, call)
+
+    def record_error(self, operation):
+        with self.lock:
+            self._stats(operation).errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict((operation, self._snapshot(stats)) for operation, stats in self.operations.items())
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def _stats(self, operation):
+        stats = self.operations.get(operation)
+        if stats is None:
+            stats = self.operations[operation] = _OperationStats(self.buckets)
+        return stats
+
+    def _snapshot(self, stats):
+        return {
+            "count": stats.count,
+            "errors": stats.errors,
+            "in_flight": stats.in_flight,
+            "request_bytes": stats.request_bytes,
+            "response_bytes": stats.response_bytes,
+            "latency": {
+                "sum": stats.latency_sum,
+                "max": stats.latency_max,
+                "mean": stats.latency_sum / stats.count if stats.count else 0.0,
+                "p50": self._percentile(stats, 0.50),
+                "p90": self._percentile(stats, 0.90),
+                "p99": self._percentile(stats, 0.99),
+                "buckets": dict(('+Inf' if bound == float('inf') else '{}'.format(bound), count)
+                                for bound, count in zip(self.buckets, stats.buckets))
+            }
+        }
+
+    def _percentile(self, stats, quantile):
+        # Upper bound of the bucket holding the quantile, capped at the slowest call seen
+        if not stats.count:
+            return 0.0
+        rank = quantile * stats.count
+        seen = 0
+        for bound, count in zip(self.buckets, stats.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, stats.latency_max)
+        return stats.latency_max
+
+    @staticmethod
+    def _run_hooks(hooks, call):
+        for hook in hooks:
+            try:
+                hook(call)
+            except Exception:
+                logger.exception("Context Broker metrics hook %r failed", hook)
@@ -0,0 +1,169 @@
+"""Compact typed view of entity responses.
+
+``Entity`` and ``Attribute`` use ``__slots__`` and parse lazily: attribute
+values are converted according to their type on first access, and metadata
+is only turned into a dict when it is read.
+"""
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return '{}'.format(value).strip().lower() in ('true', '1', 'yes')
+
+
+def _to_int(value):
+    # Only whole numbers: 22.5 typed "integer" is returned as it is rather than cut to 22
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, float):
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    if not value.is_integer():
+        raise ValueError(value)
+    return int(value)
+
+
+def _to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+CONVERTERS = {
+    'integer': _to_int,
+    'int': _to_int,
+    'Integer': _to_int,
+    'float': float,
+    'double': float,
+    'Float': float,
+    'Number': _to_number,
+    'number': _to_number,
+    'boolean': _to_bool,
+    'bool': _to_bool,
+    'Boolean': _to_bool,
+    'string': str,
+    'Text': str,
+}
+
+_UNSET = object()
+
+
+class Attribute(object):
+    __slots__ = ('name', 'type', 'raw_value', '_raw_metadatas', '_value', '_metadatas')
+
+    def __init__(self, name, type=None, value=None, metadatas=None):
+        self.name = name
+        self.type = type
+        self.raw_value = value
+        self._raw_metadatas = metadatas
+        self._value = _UNSET
+        self._metadatas = None
+
+    @property
+    def value(self):
+        if self._value is _UNSET:
+            converter = CONVERTERS.get(self.type)
+            value = self.raw_value
+            if converter is not None and value is not None:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError):
+                    pass
+            self._value = value
+        return self._value
+
+    @property
+    def metadatas(self):
+        """Metadata values keyed by name, parsed on first access."""
+        if self._metadatas is None:
+            raw = self._raw_metadatas or []
+            if isinstance(raw, dict):
+                # NGSIv2: {"<name>": {"type": ..., "value": ...}}
+                self._metadatas = dict((name, metadata.get('value')) for name, metadata in raw.items())
+            else:
+                # NGSIv1: [{"name": ..., "type": ..., "value": ...}]
+                self._metadatas = dict((metadata.get('name'), metadata.get('value')) for metadata in raw)
+        return self._metadatas
+
+    @classmethod
+    def from_v1(cls, attribute):
+        return cls(attribute.get('name'), attribute.get('type'), attribute.get('value'), attribute.get('metadatas'))
+
+    @classmethod
+    def from_v2(cls, name, attribute):
+        if not isinstance(attribute, dict):
+            # keyValues representation
+            return cls(name, None, attribute)
+        return cls(name, attribute.get('type'), attribute.get('value'), attribute.get('metadata'))
+
+    def __repr__(self):
+        return 'Attribute({!r}, {!r}, {!r})'.format(self.name, self.type, self.raw_value)
+
+
+class Entity(object):
+    __slots__ = ('id', 'type', 'attributes')
+
+    def __init__(self, entity_type, entity_id, attributes=()):
+        self.type = entity_type
+        self.id = entity_id
+        # Attribute names are unique within an entity, so the dict doubles as the lookup index
+        self.attributes = dict((attribute.name, attribute) for attribute in attributes)
+
+    @classmethod
+    def from_v1(cls, context_element):
+        return cls(
+            context_element.get('type'),
+            context_element.get('id'),
+            [Attribute.from_v1(attribute) for attribute in context_element.get('attributes') or []]
+        )
+
+    @classmethod
+    def from_v2(cls, entity):
+        return cls(
+            entity.get('type'),
+            entity.get('id'),
+            [Attribute.from_v2(name, attribute) for name, attribute in entity.items() if name not in ('id', 'type')]
+        )
+
+    @classmethod
+    def from_response(cls, response):
+        """Build an Entity from an ``entity.get`` response or an NGSIv2 entity, None if not found."""
+        if 'contextElement' in response:
+            if (response.get('statusCode') or {}).get('code') != '200':
+                return None
+            return cls.from_v1(response['contextElement'])
+        if 'id' in response and 'error' not in response:
+            return cls.from_v2(response)
+        return None
+
+    def get(self, attribute_name, default=None):
+        return self.attributes.get(attribute_name, default)
+
+    def get_value(self, attribute_name, default=None):
+        attribute = self.attributes.get(attribute_name)
+        if attribute is None:
+            return default
+        return attribute.value
+
+    def __getitem__(self, attribute_name):
+        return self.attributes[attribute_name]
+
+    def __contains__(self, attribute_name):
+        return attribute_name in self.attributes
+
+    def __iter__(self):
+        return iter(self.attributes.values())
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def __repr__(self):
+        return 'Entity({!r}, {!r}, [{}])'.format(self.type, self.id, ', '.join(self.attributes))
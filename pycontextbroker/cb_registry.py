@@ -0,0 +1,299 @@
+import logging
+import re
+import threading
+import time
+
+from .cb_subscription import DEFAULT_DURATION, DEFAULT_THROTTLING
+
+logger = logging.getLogger(__name__)
+
+DURATION_PATTERN = re.compile(
+    r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$'
+)
+# Seconds per year, month, week, day, hour, minute and second, months and years as Orion counts them
+DURATION_UNITS = (365 * 86400, 30 * 86400, 7 * 86400, 86400, 3600, 60, 1)
+
+
+def parse_duration(duration):
+    """ISO 8601 duration ('P1M', 'PT5S', 'P1DT12H') -> seconds, None if it can't be read."""
+    match = DURATION_PATTERN.match(duration or '')
+    if not match or duration in ('P', 'PT'):
+        return None
+    return sum(float(value) * unit for value, unit in zip(match.groups(), DURATION_UNITS) if value)
+
+
+class _Registration(object):
+    __slots__ = ('subscription_id', 'entities', 'attributes', 'reference', 'duration', 'throttling', 'expires_at')
+
+    def __init__(self, subscription_id, entities, attributes, reference, duration, throttling):
+        self.subscription_id = subscription_id
+        self.entities = entities
+        self.attributes = attributes
+        self.reference = reference
+        self.duration = duration
+        self.throttling = throttling
+        self.expires_at = None
+
+
+class SubscriptionRegistry(object):
+    """Keeps track of the subscriptions made through it so none is created twice, and renews them.
+
+    Subscribing again to something an existing subscription already covers
+    (same reference and attributes, and the same entity or an idPattern
+    matching it) returns the existing subscription id without a request.
+    A background thread renews every subscription whose expiration is less
+    than ``renew_before`` seconds away, checking every ``renew_interval``
+    seconds (``None`` leaves renewals to ``renew()``). Subscriptions the
+    broker no longer knows are created again.
+
+    No request is made while holding ``lock``, so lookups answered from the
+    registry never wait for the broker; creations are serialized by
+    ``subscribe_lock`` so two callers can't create the same subscription.
+    """
+
+    def __init__(self, subscription, duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING, renew_before=3600,
+                 renew_interval=60.0):
+        self.subscription = subscription
+        self.duration = duration
+        self.throttling = throttling
+        self.renew_before = renew_before
+        self.renew_interval = renew_interval
+        self.registrations = {}
+        # (entity_type, entity_id, reference) -> subscription ids, and the idPattern registrations
+        self.entity_index = {}
+        self.patterns = []
+        self.lock = threading.RLock()
+        self.subscribe_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.deduplicated = 0
+        self.renewed = 0
+        self.failed = 0
+
+        self.thread = None
+        if renew_interval is not None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def on_change(self, entity_type, entity_id, attribute_name, subscriber_endpoint, duration=None, throttling=None):
+        attribute_names = self._names(attribute_name)
+        subscription_id = self._deduplicate(self._covering, entity_type, entity_id, attribute_names,
+                                            subscriber_endpoint)
+        if subscription_id is not None:
+            return subscription_id
+        with self.subscribe_lock:
+            subscription_id = self._deduplicate(self._covering, entity_type, entity_id, attribute_names,
+                                                subscriber_endpoint)
+            if subscription_id is not None:
+                return subscription_id
+            entities = [{"type": entity_type, "isPattern": "false", "id": entity_id}]
+            return self._subscribe(entities, attribute_names, subscriber_endpoint, duration, throttling)
+
+    def on_change_pattern(self, entity_type, id_pattern, attribute_names, subscriber_endpoint, duration=None,
+                          throttling=None):
+        attribute_names = self._names(attribute_names)
+        subscription_id = self._deduplicate(self._same_pattern, entity_type, id_pattern, attribute_names,
+                                            subscriber_endpoint)
+        if subscription_id is not None:
+            return subscription_id
+        with self.subscribe_lock:
+            subscription_id = self._deduplicate(self._same_pattern, entity_type, id_pattern, attribute_names,
+                                                subscriber_endpoint)
+            if subscription_id is not None:
+                return subscription_id
+            entities = [{"type": entity_type, "isPattern": "true", "id": id_pattern}]
+            return self._subscribe(entities, attribute_names, subscriber_endpoint, duration, throttling)
+
+    def on_type_change(self, entity_type, attribute_names, subscriber_endpoint, duration=None, throttling=None):
+        return self.on_change_pattern(entity_type, '.*', attribute_names, subscriber_endpoint, duration, throttling)
+
+    def on_change_many(self, entities, attribute_names, subscriber_endpoint, duration=None, throttling=None,
+                       chunk_size=100):
+        """Subscribe the entities not covered yet, ``chunk_size`` per subscription. Returns the new subscription ids."""
+        attribute_names = self._names(attribute_names)
+        with self.subscribe_lock:
+            missing, seen = [], set()
+            with self.lock:
+                for entity_type, entity_id in entities:
+                    if (entity_type, entity_id) in seen or \
+                            self._covering(entity_type, entity_id, attribute_names, subscriber_endpoint) is not None:
+                        self.deduplicated += 1
+                    else:
+                        missing.append((entity_type, entity_id))
+                        seen.add((entity_type, entity_id))
+
+            subscription_ids = []
+            for start in range(0, len(missing), chunk_size):
+                chunk = [{"type": entity_type, "isPattern": "false", "id": entity_id}
+                         for entity_type, entity_id in missing[start:start + chunk_size]]
+                subscription_id = self._subscribe(chunk, attribute_names, subscriber_endpoint, duration, throttling)
+                if subscription_id is not None:
+                    subscription_ids.append(subscription_id)
+            return subscription_ids
+
+    def renew(self, force=False):
+        """Renew the subscriptions about to expire (all of them with ``force``), returns how many were renewed."""
+        with self.lock:
+            now = time.monotonic()
+            due = [registration for registration in list(self.registrations.values())
+                   if force or (registration.expires_at is not None and
+                                registration.expires_at - now <= self.renew_before)]
+        renewed = 0
+        for registration in due:
+            renewed += self._renew(registration)
+        return renewed
+
+    def unsubscribe(self, subscription_id):
+        with self.lock:
+            registration = self.registrations.get(subscription_id)
+            if registration is not None:
+                self._forget(registration)
+        return self.subscription.unsubscribe(subscription_id)
+
+    def close(self, unsubscribe=False):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if unsubscribe:
+            for subscription_id in list(self.registrations):
+                self.unsubscribe(subscription_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscriptions": len(self.registrations),
+                "deduplicated": self.deduplicated,
+                "renewed": self.renewed,
+                "failed": self.failed
+            }
+
+    def __len__(self):
+        return len(self.registrations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Registrations
+    @staticmethod
+    def _names(attribute_names):
+        if isinstance(attribute_names, str):
+            return [attribute_names]
+        return list(attribute_names)
+
+    @staticmethod
+    def _covers(registration, attribute_names, reference):
+        return registration.reference == reference and set(attribute_names) <= set(registration.attributes)
+
+    def _deduplicate(self, covering, entity_type, entity_id, attribute_names, reference):
+        with self.lock:
+            subscription_id = covering(entity_type, entity_id, attribute_names, reference)
+            if subscription_id is not None:
+                self.deduplicated += 1
+            return subscription_id
+
+    def _same_pattern(self, entity_type, id_pattern, attribute_names, reference):
+        for registration in self.patterns:
+            entity = registration.entities[0]
+            if entity["type"] == entity_type and entity["id"] == id_pattern and \
+                    self._covers(registration, attribute_names, reference):
+                return registration.subscription_id
+        return None
+
+    def _covering(self, entity_type, entity_id, attribute_names, reference):
+        for subscription_id in self.entity_index.get((entity_type, entity_id, reference)) or ():
+            if self._covers(self.registrations[subscription_id], attribute_names, reference):
+                return subscription_id
+        # Orion searches idPatterns anywhere in the id, as re.search does
+        for registration in self.patterns:
+            entity = registration.entities[0]
+            if entity["type"] == entity_type and self._covers(registration, attribute_names, reference) and \
+                    re.search(entity["id"], entity_id):
+                return registration.subscription_id
+        return None
+
+    def _subscribe(self, entities, attribute_names, reference, duration, throttling):
+        duration = duration or self.duration
+        throttling = throttling or self.throttling
+        if entities[0]["isPattern"] == "true":
+            response = self.subscription.on_change_pattern(entities[0]["type"], entities[0]["id"], attribute_names,
+                                                           reference, duration, throttling)
+        else:
+            response = self.subscription.on_change_many([(entity["type"], entity["id"]) for entity in entities],
+                                                        attribute_names, reference, duration, throttling,
+                                                        chunk_size=len(entities))[0]
+        subscribe_response = response.get('subscribeResponse') if isinstance(response, dict) else None
+        if not subscribe_response:
+            with self.lock:
+                self.failed += 1
+            logger.error("Failed to create Orion Context Broker subscription: %s", response)
+            return None
+
+        registration = _Registration(subscribe_response['subscriptionId'], entities, attribute_names, reference,
+                                     duration, throttling)
+        with self.lock:
+            self._expires(registration, subscribe_response.get('duration'))
+            self.registrations[registration.subscription_id] = registration
+            if entities[0]["isPattern"] == "true":
+                self.patterns.append(registration)
+            else:
+                for entity in entities:
+                    key = (entity["type"], entity["id"], reference)
+                    self.entity_index.setdefault(key, []).append(registration.subscription_id)
+        return registration.subscription_id
+
+    def _forget(self, registration):
+        self.registrations.pop(registration.subscription_id, None)
+        if registration in self.patterns:
+            self.patterns.remove(registration)
+        for entity in registration.entities:
+            key = (entity["type"], entity["id"], registration.reference)
+            subscription_ids = self.entity_index.get(key) or []
+            if registration.subscription_id in subscription_ids:
+                subscription_ids.remove(registration.subscription_id)
+            if not subscription_ids:
+                self.entity_index.pop(key, None)
+
+    def _renew(self, registration):
+        try:
+            response = self.subscription.update(registration.subscription_id, duration=registration.duration)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            logger.exception("Failed to renew Orion Context Broker subscription %s", registration.subscription_id)
+            return 0
+
+        if not (response or {}).get('subscribeResponse'):
+            # The broker lost or expired the subscription, create it again
+            logger.warning("Orion Context Broker subscription %s is gone, subscribing again: %s",
+                           registration.subscription_id, response)
+            with self.subscribe_lock:
+                with self.lock:
+                    if self.registrations.get(registration.subscription_id) is not registration:
+                        # Unsubscribed meanwhile
+                        return 0
+                    self._forget(registration)
+                subscription_id = self._subscribe(registration.entities, registration.attributes,
+                                                  registration.reference, registration.duration,
+                                                  registration.throttling)
+            if subscription_id is None:
+                return 0
+        else:
+            with self.lock:
+                self._expires(registration, response['subscribeResponse'].get('duration'))
+        with self.lock:
+            self.renewed += 1
+        return 1
+
+    def _expires(self, registration, duration):
+        seconds = parse_duration(duration or registration.duration)
+        registration.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    def _run(self):
+        while not self.stopped.wait(self.renew_interval):
+            try:
+                self.renew()
+            except Exception:
+                logger.exception("Failed to renew Orion Context Broker subscriptions")
@@ -0,0 +1,313 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import requests
+
+# Safe to send twice: the second attempt leaves the broker in the same state as the first
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+# POST requests that only read from the broker
+READ_OPERATIONS = frozenset(['entity.query'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+def is_idempotent(method, operation=None):
+    return method in IDEMPOTENT_METHODS or operation in READ_OPERATIONS
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request while the circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Opens after ``failure_threshold`` consecutive failures and fails fast for ``reset_timeout`` seconds.
+
+    Once the timeout is over a single probe request is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def release(self):
+        # The probe was cancelled before it got an answer, let the next request probe instead
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+class ResiliencePolicy(object):
+    """Timeouts, retries, hedged reads and circuit breaking for every request of a connection.
+
+    ``timeouts`` maps operation names (e.g. 'entity.get') to a timeout in
+    seconds. Idempotent requests are retried up to ``retries`` times on
+    errors and ``retry_statuses``, sleeping a random (full jitter) delay of
+    at most ``backoff * 2 ** attempt`` seconds, capped at ``max_backoff``.
+    With ``hedge_percentile`` set (e.g. 0.95), a read that is slower than
+    that percentile of its recent latencies is sent a second time and the
+    first answer wins. ``failure_threshold=None`` disables the breaker.
+    """
+
+    def __init__(self, timeouts=None, retries=2, backoff=0.05, max_backoff=1.0, retry_statuses=RETRY_STATUSES,
+                 hedge_percentile=None, hedge_min_samples=20, hedge_workers=16, window=200,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.timeouts = timeouts or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_workers = hedge_workers
+        self.window = window
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout) if failure_threshold else None
+        self.latencies = {}
+        self.counters = {"retries": 0, "hedged": 0, "hedge_wins": 0, "short_circuited": 0}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def call(self, send, method, url, data=None, operation=None, hedge=True, **kwargs):
+        """Send through ``send(method, url, data, operation, **kwargs)``, which returns (status, result).
+
+        ``hedge=False`` never sends the request twice at once, for streamed responses.
+        """
+        operation = operation or method
+        timeout = self.timeouts.get(operation)
+        if timeout is not None:
+            kwargs.setdefault('timeout', timeout)
+
+        attempts = self._attempts(method, operation)
+        for attempt in range(attempts):
+            self._allow(operation)
+            try:
+                if hedge and self._hedges(method, operation):
+                    status, result = self._hedged(send, (method, url, data, operation), kwargs)
+                else:
+                    status, result = self._measured(send, (method, url, data, operation), kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception:
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                if status not in self.retry_statuses or attempt + 1 >= attempts:
+                    return result
+                self._discard(result)
+            self._count('retries')
+            time.sleep(self._backoff(attempt))
+
+    async def acall(self, send, method, url, data=None, operation=None, hedge=True, **kwargs):
+        """asyncio variant of ``call``, timeouts are applied with asyncio.wait_for."""
+        operation = operation or method
+        timeout = self.timeouts.get(operation)
+
+        attempts = self._attempts(method, operation)
+        for attempt in range(attempts):
+            self._allow(operation)
+            try:
+                if hedge and self._hedges(method, operation):
+                    status, result = await self._ahedged(send, (method, url, data, operation), kwargs, timeout)
+                else:
+                    status, result = await self._ameasured(send, (method, url, data, operation), kwargs, timeout)
+            except CircuitOpenError:
+                raise
+            except Exception:
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                if status not in self.retry_statuses or attempt + 1 >= attempts:
+                    return result
+                self._discard(result)
+            self._count('retries')
+            await asyncio.sleep(self._backoff(attempt))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["circuit"] = self.breaker.state if self.breaker is not None else None
+        return stats
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    # Policy
+    def _attempts(self, method, operation):
+        return 1 + (self.retries if is_idempotent(method, operation) else 0)
+
+    def _hedges(self, method, operation):
+        return self.hedge_percentile is not None and (method == 'GET' or operation in READ_OPERATIONS)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _allow(self, operation):
+        if self.breaker is not None and not self.breaker.allow():
+            self._count('short_circuited')
+            raise CircuitOpenError("Circuit breaker is open, not sending {}".format(operation))
+
+    def _hedge_delay(self, operation):
+        # None until enough latencies were seen to tell what "slow" is
+        with self.lock:
+            latencies = self.latencies.get(operation)
+            if latencies is None or len(latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(int(self.hedge_percentile * len(ordered)), len(ordered) - 1)]
+
+    def _record(self, operation, latency, failed):
+        if self.breaker is not None:
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        if latency is not None and not failed:
+            with self.lock:
+                latencies = self.latencies.get(operation)
+                if latencies is None:
+                    latencies = self.latencies[operation] = deque(maxlen=self.window)
+                latencies.append(latency)
+
+    def _count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    @staticmethod
+    def _discard(result):
+        # An unread (streamed) response holds its pooled connection until closed
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+
+    def _discard_later(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._discard(future.result()[1])
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.hedge_workers)
+            return self.executor
+
+    # Sending
+    def _measured(self, send, args, kwargs):
+        started = time.monotonic()
+        try:
+            status, result = send(*args, **kwargs)
+        except Exception:
+            self._record(args[3], None, failed=True)
+            raise
+        self._record(args[3], time.monotonic() - started, failed=status >= 500)
+        return status, result
+
+    def _hedged(self, send, args, kwargs):
+        delay = self._hedge_delay(args[3])
+        if delay is None:
+            return self._measured(send, args, kwargs)
+
+        executor = self._get_executor()
+        futures = [executor.submit(self._measured, send, args, kwargs)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            self._count('hedged')
+            futures.append(executor.submit(self._measured, send, args, kwargs))
+
+        # First successful answer wins, the slower one is left to finish in the background
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as exception:
+                error = exception
+                continue
+            if future is not futures[0]:
+                self._count('hedge_wins')
+            for loser in futures:
+                if loser is not future:
+                    loser.add_done_callback(self._discard_later)
+            return result
+        raise error
+
+    async def _ameasured(self, send, args, kwargs, timeout):
+        started = time.monotonic()
+        try:
+            if timeout is not None:
+                status, result = await asyncio.wait_for(send(*args, **kwargs), timeout)
+            else:
+                status, result = await send(*args, **kwargs)
+        except asyncio.CancelledError:
+            if self.breaker is not None:
+                self.breaker.release()
+            raise
+        except Exception:
+            self._record(args[3], None, failed=True)
+            raise
+        self._record(args[3], time.monotonic() - started, failed=status >= 500)
+        return status, result
+
+    async def _ahedged(self, send, args, kwargs, timeout):
+        delay = self._hedge_delay(args[3])
+        if delay is None:
+            return await self._ameasured(send, args, kwargs, timeout)
+
+        tasks = [asyncio.ensure_future(self._ameasured(send, args, kwargs, timeout))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            self._count('hedged')
+            tasks.append(asyncio.ensure_future(self._ameasured(send, args, kwargs, timeout)))
+
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not tasks[0]:
+                        self._count('hedge_wins')
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,241 @@
+import bisect
+import hashlib
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from .cb_resilience import is_idempotent
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = 'least_outstanding'
+LATENCY = 'latency'
+
+# Weight of the newest sample in a node's latency moving average
+LATENCY_SMOOTHING = 0.2
+# Points per node on the hash ring, enough to spread entities evenly over a handful of nodes
+RING_REPLICAS = 100
+
+
+def node_address(node):
+    """'host:port', ('host', port) or 'http://host:port' -> 'http://host:port'."""
+    if isinstance(node, (tuple, list)):
+        return 'http://{}:{}'.format(*node)
+    if '://' not in node:
+        return 'http://' + node
+    return node.rstrip('/')
+
+
+class ContextBrokerNode(object):
+    __slots__ = ('address', 'outstanding', 'latency', 'requests', 'failures', 'down_until')
+
+    def __init__(self, address):
+        self.address = address
+        self.outstanding = 0
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.monotonic()
+
+
+class ContextBrokerRouter(object):
+    """Spreads requests over several Orion nodes sharing one database.
+
+    Every request is built against the first node and sent to the node
+    with the fewest requests in flight (``balance='least_outstanding'``)
+    or the lowest smoothed latency (``balance='latency'``). Nodes that fail
+    to connect are skipped for ``retry_after`` seconds and the request
+    moves on to the next node. With ``pin_writes`` the writes of one entity
+    always go to the same node (consistent hashing), so they are applied
+    in order. A background thread checks ``/version`` on every node each
+    ``health_interval`` seconds (``None`` disables it).
+
+    Only idempotent requests move on to the next node after any of the
+    failover errors: a POST that timed out may have been applied by the
+    first node already. Those only fail over when ``unsent(error)`` tells
+    the request never left the client (connection refused or timed out).
+    """
+
+    def __init__(self, nodes, balance=LEAST_OUTSTANDING, pin_writes=False, health_interval=5.0, health_timeout=2.0,
+                 retry_after=10.0):
+        if balance not in (LEAST_OUTSTANDING, LATENCY):
+            raise ValueError("Unknown balance strategy: {}".format(balance))
+
+        addresses = []
+        for node in nodes:
+            address = node_address(node)
+            if address not in addresses:
+                addresses.append(address)
+        self.nodes = [ContextBrokerNode(address) for address in addresses]
+        self.balance = balance
+        self.pin_writes = pin_writes
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.retry_after = retry_after
+        self.ring = self._build_ring(self.nodes)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.health_thread = None
+        if health_interval is not None and len(self.nodes) > 1:
+            self.health_thread = threading.Thread(target=self._check_health, name='cb-router-health')
+            self.health_thread.daemon = True
+            self.health_thread.start()
+
+    @property
+    def address(self):
+        return self.nodes[0].address
+
+    def candidates(self, method, route_key=None):
+        """Nodes to try for a request, in order: healthy ones first, best one first."""
+        if self.pin_writes and route_key is not None and method != 'GET':
+            nodes = self._ring_nodes(route_key)
+        else:
+            with self.lock:
+                nodes = sorted(self.nodes, key=self._score)
+        healthy = [node for node in nodes if node.healthy]
+        # When every node looks down, keep trying them rather than failing without a request
+        return healthy + [node for node in nodes if not node.healthy]
+
+    def rewrite(self, url, node):
+        if url.startswith(self.address):
+            return node.address + url[len(self.address):]
+        return url
+
+    def send(self, send, method, url, data=None, operation=None, route_key=None, errors=(), unsent=None, **kwargs):
+        """Send through ``send(method, url, data, operation, **kwargs)``, moving to the next node on ``errors``."""
+        nodes = self.candidates(method, route_key)
+        for index, node in enumerate(nodes):
+            started = self._begin(node)
+            try:
+                result = send(method, self.rewrite(url, node), data, operation, **kwargs)
+            except errors as error:
+                self._end(node, started, failed=True)
+                if index + 1 >= len(nodes) or not self._may_resend(method, operation, error, unsent):
+                    raise
+                logger.warning("Context Broker node %s failed, trying %s", node.address, nodes[index + 1].address)
+                continue
+            except BaseException:
+                self._end(node, started, failed=False)
+                raise
+            self._end(node, started, failed=False)
+            return result
+
+    async def asend(self, send, method, url, data=None, operation=None, route_key=None, errors=(), unsent=None,
+                    **kwargs):
+        """asyncio variant of ``send``."""
+        nodes = self.candidates(method, route_key)
+        for index, node in enumerate(nodes):
+            started = self._begin(node)
+            try:
+                result = await send(method, self.rewrite(url, node), data, operation, **kwargs)
+            except errors as error:
+                self._end(node, started, failed=True)
+                if index + 1 >= len(nodes) or not self._may_resend(method, operation, error, unsent):
+                    raise
+                logger.warning("Context Broker node %s failed, trying %s", node.address, nodes[index + 1].address)
+                continue
+            except BaseException:
+                self._end(node, started, failed=False)
+                raise
+            self._end(node, started, failed=False)
+            return result
+
+    def mark_down(self, node):
+        with self.lock:
+            node.down_until = time.monotonic() + self.retry_after
+
+    def mark_up(self, node):
+        with self.lock:
+            node.down_until = 0.0
+
+    def stats(self):
+        with self.lock:
+            return [{
+                "address": node.address,
+                "healthy": node.healthy,
+                "outstanding": node.outstanding,
+                "latency": node.latency,
+                "requests": node.requests,
+                "failures": node.failures
+            } for node in self.nodes]
+
+    def close(self):
+        self.stopped.set()
+
+    @staticmethod
+    def _may_resend(method, operation, error, unsent):
+        return is_idempotent(method, operation) or (unsent is not None and unsent(error))
+
+    # Balancing
+    def _score(self, node):
+        if self.balance == LATENCY:
+            # Nodes without samples yet are tried first so they get measured
+            return node.latency or 0.0, node.outstanding, random.random()
+        return node.outstanding, random.random()
+
+    def _begin(self, node):
+        with self.lock:
+            node.outstanding += 1
+            node.requests += 1
+        return time.monotonic()
+
+    def _end(self, node, started, failed):
+        latency = time.monotonic() - started
+        with self.lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                node.down_until = time.monotonic() + self.retry_after
+                return
+            if node.latency is None:
+                node.latency = latency
+            else:
+                node.latency += LATENCY_SMOOTHING * (latency - node.latency)
+
+    # Consistent hashing
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    @classmethod
+    def _build_ring(cls, nodes):
+        return sorted((cls._hash('{}#{}'.format(node.address, replica)), index)
+                      for index, node in enumerate(nodes) for replica in range(RING_REPLICAS))
+
+    def _ring_nodes(self, route_key):
+        # Distinct nodes in ring order from the key's position, the first one owns the key
+        position = bisect.bisect(self.ring, (self._hash('{}/{}'.format(*route_key)),))
+        nodes = []
+        for offset in range(len(self.ring)):
+            node = self.nodes[self.ring[(position + offset) % len(self.ring)][1]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+    # Health
+    def _check_health(self):
+        session = requests.Session()
+        try:
+            while not self.stopped.wait(self.health_interval):
+                for node in self.nodes:
+                    try:
+                        healthy = session.get(node.address + '/version', timeout=self.health_timeout).ok
+                    except requests.exceptions.RequestException:
+                        healthy = False
+                    if healthy:
+                        self.mark_up(node)
+                    else:
+                        if node.healthy:
+                            logger.warning("Context Broker node %s is down", node.address)
+                        self.mark_down(node)
+        finally:
+            session.close()
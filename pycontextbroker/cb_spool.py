@@ -0,0 +1,393 @@
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from .cb_json import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Spooled writes are replayed with APPEND, which creates the entity or attribute when missing
+SPOOL_ACTION = 'APPEND'
+# Errors telling the broker is unreachable or overloaded, rather than rejecting the write.
+# A 5xx answer from a proxy in front of Orion is not JSON, so it fails to parse.
+UNAVAILABLE_ERRORS = (requests.exceptions.RequestException, ValueError)
+
+
+class BrokerUnavailableError(requests.exceptions.RequestException):
+    """Raised when the broker answers a replayed batch with a 5xx status."""
+
+
+class WriteSpool(object):
+    """Write-ahead spool for entity and attribute writes, replayed once the broker is back.
+
+    While the spool is empty, writes go straight to the broker as batch
+    APPEND requests, with ``write_timeout``. A write that fails to connect,
+    times out or gets a 5xx answer is appended to the log at ``path``
+    instead, one JSON record per line. Every later write is appended too
+    until the spool has drained, so writes reach the broker in order: a
+    write sent directly while another one failed is spooled after it as
+    well, so replaying the failed one does not undo it. The
+    log is fsynced every ``sync_interval`` seconds or every ``sync_every``
+    records, whichever comes first.
+
+    A background thread reads the log back through a memory map. Only the
+    last value of each attribute is kept. The writes are replayed
+    ``batch_size`` entities per request and at most ``max_rate`` entities a
+    second. While the broker stays down the thread tries again every
+    ``retry_interval`` seconds. A log that reaches ``max_size`` bytes is
+    compacted, and writes are dropped while it is still full. Spooled
+    writes that were not replayed are picked up again by the next spool
+    opened on the same ``path``.
+    """
+
+    def __init__(self, batch, path, max_size=64 * 1024 * 1024, sync_interval=0.5, sync_every=1000, batch_size=100,
+                 max_rate=None, retry_interval=5.0, write_timeout=None):
+        self.batch = batch
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.sync_every = sync_every
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.retry_interval = retry_interval
+        self.write_timeout = write_timeout
+        self.lock = threading.Lock()
+        # Failed direct writes not spooled yet, later writes are spooled after them
+        self.diverting = 0
+        self.diverted = threading.Condition(self.lock)
+        # Held while the log is read back, so it is not compacted or truncated meanwhile
+        self.replay_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.closed = False
+        self.direct = 0
+        self.spooled = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.failed = 0
+        self.replays = 0
+        self.compactions = 0
+        self.syncs = 0
+        self.unsynced = 0
+        self.next_replay = 0.0
+
+        self.file = open(path, 'ab')
+        self.size = self._recover()
+        self.compacted_size = 0
+        self.checkpoint = self._load_checkpoint()
+        self.pending, self.oldest = 0, None
+        for _, record in self._records(self.checkpoint, self.size):
+            if self.oldest is None:
+                self.oldest = record.get('time')
+            self.pending += 1
+
+        self.thread = threading.Thread(target=self._run, name='cb-spool')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def create(self, entity_type, entity_id, attributes=None):
+        return self.write(entity_type, entity_id, self._attributes(attributes))
+
+    def update_value(self, entity_type, entity_id, attribute_name, attribute_value, attribute_type=None,
+                     metadatas=None):
+        attribute_data = {"name": attribute_name, "value": attribute_value}
+        if attribute_type:
+            attribute_data['type'] = attribute_type
+        if metadatas:
+            attribute_data['metadatas'] = metadatas
+        return self.write(entity_type, entity_id, [attribute_data])
+
+    def write(self, entity_type, entity_id, attributes):
+        """Send or spool the attributes of one entity, False if the write was dropped because the spool is full."""
+        with self.lock:
+            direct = not (self.closed or self.pending or self.diverting)
+        if not direct:
+            return self._append(entity_type, entity_id, attributes)
+
+        sent = self._send(entity_type, entity_id, attributes)
+        with self.lock:
+            if not sent:
+                self.diverting += 1
+            elif not (self.pending or self.diverting):
+                return True
+        # Failed, or sent while an earlier write failed: replayed after it
+        return self._append(entity_type, entity_id, attributes, diverted=not sent) or sent
+
+    def replay(self):
+        """Send the spooled writes to the broker, returns how many entity updates were sent.
+
+        Raises the error that interrupted the replay, the writes then stay spooled.
+        """
+        with self.replay_lock:
+            with self.lock:
+                self._sync()
+                start, end = self.checkpoint, self.size
+            if end <= start:
+                return 0
+
+            updates, records, coalesced = self._compacted(self._records(start, end))
+            sent = failed = 0
+            for chunk_start in range(0, len(updates), self.batch_size):
+                chunk = [update[:3] for update in updates[chunk_start:chunk_start + self.batch_size]]
+                started = time.monotonic()
+                results = self.batch.update(chunk, SPOOL_ACTION, self.write_timeout)
+                unavailable = [r for r in results if self._unavailable(r)]
+                if unavailable:
+                    raise BrokerUnavailableError("Context Broker answered {}".format(unavailable[0]['statusCode']))
+                rejected = [r for r in results if (r.get('statusCode') or {}).get('code') != '200']
+                if rejected:
+                    logger.error("Context Broker rejected spooled writes: %s", rejected)
+                sent += len(chunk)
+                failed += len(rejected)
+
+                if self.max_rate:
+                    delay = float(len(chunk)) / self.max_rate - (time.monotonic() - started)
+                    if delay > 0 and self.stopped.wait(delay):
+                        # Closing, what is left is replayed by the next spool on this path
+                        return sent
+
+            with self.lock:
+                self.replays += 1
+                self.replayed += sent
+                self.failed += failed
+                self.coalesced += coalesced
+                self.pending -= records
+                if self.size == end:
+                    # Caught up: start the log over. Truncated first, so a crash before the checkpoint
+                    # is stored leaves a checkpoint past the end of the log, which is read as 0.
+                    self.file.truncate(0)
+                    self.size = self.compacted_size = 0
+                    self._store_checkpoint(0)
+                    self.oldest = None
+                else:
+                    self._store_checkpoint(end)
+                    self.oldest = next((record.get('time') for _, record in self._records(end, self.size)), None)
+            return sent
+
+    def compact(self):
+        """Rewrite the log with only the last value of each spooled attribute, returns the bytes freed."""
+        with self.replay_lock:
+            with self.lock:
+                if self.closed:
+                    return 0
+                self._sync()
+                updates, records, coalesced = self._compacted(self._records(self.checkpoint, self.size))
+                compacted_path = self.path + '.compact'
+                with open(compacted_path, 'wb') as log:
+                    for entity_type, entity_id, attributes, recorded_at in updates:
+                        log.write(self._record(entity_type, entity_id, attributes, recorded_at))
+                    log.flush()
+                    os.fsync(log.fileno())
+                    size = log.tell()
+
+                # Checkpoint first: a crash in between replays the old log from the start, which is redundant
+                # but loses nothing, while the old checkpoint would skip records of the compacted log
+                self._store_checkpoint(0)
+                self.file.close()
+                os.replace(compacted_path, self.path)
+                self.file = open(self.path, 'ab')
+
+                freed = self.size - size
+                self.size = self.compacted_size = size
+                self.pending = len(updates)
+                self.coalesced += coalesced
+                self.compactions += 1
+                return freed
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        """Stop the replay thread and close the log, writes not replayed yet stay in it."""
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self._sync()
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "size": self.size,
+                "lag": time.time() - self.oldest if self.oldest is not None else 0.0,
+                "direct": self.direct,
+                "spooled": self.spooled,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "replayed": self.replayed,
+                "failed": self.failed,
+                "replays": self.replays,
+                "compactions": self.compactions,
+                "syncs": self.syncs
+            }
+
+    # Writes
+    @staticmethod
+    def _attributes(attributes):
+        if isinstance(attributes, dict):
+            # {"number": 1} shorthand for [{"name": "number", "value": 1}]
+            return [{"name": name, "value": value} for name, value in attributes.items()]
+        return list(attributes or [])
+
+    @staticmethod
+    def _unavailable(result):
+        return str((result.get('statusCode') or {}).get('code')).startswith('5')
+
+    def _send(self, entity_type, entity_id, attributes):
+        try:
+            result = self.batch.update([(entity_type, entity_id, attributes)], SPOOL_ACTION, self.write_timeout)[0]
+        except UNAVAILABLE_ERRORS as error:
+            logger.warning("Context Broker unavailable, spooling writes to %s: %s", self.path, error)
+            self.next_replay = time.monotonic() + self.retry_interval
+            return False
+        if self._unavailable(result):
+            logger.warning("Context Broker answered %s, spooling writes to %s", result['statusCode'], self.path)
+            self.next_replay = time.monotonic() + self.retry_interval
+            return False
+
+        with self.lock:
+            self.direct += 1
+            if (result.get('statusCode') or {}).get('code') != '200':
+                self.failed += 1
+        return True
+
+    def _append(self, entity_type, entity_id, attributes, diverted=False):
+        recorded_at = time.time()
+        record = self._record(entity_type, entity_id, attributes, recorded_at)
+        # Make room by dropping the values already overwritten, unless a replay is on its way to free it all.
+        # Not again before a quarter of the log was written since the last compaction, which may have freed nothing.
+        if self.size + len(record) > self.max_size and self.size - self.compacted_size >= self.max_size // 4 and \
+                self.replay_lock.acquire(False):
+            self.replay_lock.release()
+            self.compact()
+
+        with self.lock:
+            if diverted:
+                self.diverting -= 1
+                self.diverted.notify_all()
+            else:
+                while self.diverting:
+                    self.diverted.wait()
+            if self.closed or self.size + len(record) > self.max_size:
+                self.dropped += 1
+                return False
+            self.file.write(record)
+            self.file.flush()
+            self.size += len(record)
+            if not self.pending:
+                self.oldest = recorded_at
+            self.pending += 1
+            self.spooled += 1
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+        return True
+
+    @staticmethod
+    def _record(entity_type, entity_id, attributes, recorded_at):
+        record = {"type": entity_type, "id": entity_id, "attributes": attributes, "time": recorded_at}
+        return (dumps(record) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _compacted(records):
+        """[(entity_type, entity_id, attributes, first recorded at)], records read and attribute values dropped."""
+        entities = OrderedDict()
+        count = coalesced = 0
+        for _, record in records:
+            count += 1
+            key = (record['type'], record['id'])
+            entity = entities.get(key)
+            if entity is None:
+                entity = entities[key] = (OrderedDict(), record.get('time'))
+            for attribute_data in record.get('attributes') or ():
+                if attribute_data['name'] in entity[0]:
+                    coalesced += 1
+                entity[0][attribute_data['name']] = attribute_data
+        updates = [(entity_type, entity_id, list(attributes.values()), recorded_at)
+                   for (entity_type, entity_id), (attributes, recorded_at) in entities.items()]
+        return updates, count, coalesced
+
+    # Log
+    def _records(self, start, end):
+        """(offset after, record) of each record of the log between the ``start`` and ``end`` offsets."""
+        if end <= start:
+            return
+        with open(self.path, 'rb') as log:
+            with mmap.mmap(log.fileno(), end, access=mmap.ACCESS_READ) as view:
+                position = start
+                while position < end:
+                    newline = view.find(b'\n', position, end)
+                    if newline < 0:
+                        return
+                    try:
+                        record = loads(view[position:newline])
+                    except ValueError:
+                        logger.error("Skipping unreadable record at offset %s of %s", position, self.path)
+                    else:
+                        yield newline + 1, record
+                    position = newline + 1
+
+    def _recover(self):
+        # A record cut short by a crash is dropped, the write it held was never acknowledged as durable
+        size = os.path.getsize(self.path)
+        if not size:
+            return 0
+        with open(self.path, 'rb') as log:
+            with mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ) as view:
+                end = view.rfind(b'\n') + 1
+        if end < size:
+            logger.warning("Dropping %s bytes of a truncated record at the end of %s", size - end, self.path)
+            self.file.truncate(end)
+        return end
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.offset_path) as offset_file:
+                checkpoint = int(offset_file.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+        # Past the end when the log was started over but the checkpoint not stored yet
+        return checkpoint if checkpoint <= self.size else 0
+
+    def _store_checkpoint(self, offset):
+        # Not fsynced: a checkpoint lost in a crash only makes the next spool replay some writes again
+        temporary_path = self.offset_path + '.tmp'
+        with open(temporary_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+        os.replace(temporary_path, self.offset_path)
+        self.checkpoint = offset
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.syncs += 1
+
+    def _run(self):
+        while not self.stopped.wait(self.sync_interval):
+            try:
+                self.sync()
+                if self.pending and time.monotonic() >= self.next_replay:
+                    self.replay()
+            except UNAVAILABLE_ERRORS as error:
+                logger.warning("Context Broker still unavailable, %s writes stay spooled: %s", self.pending, error)
+                self.next_replay = time.monotonic() + self.retry_interval
+            except Exception:
+                logger.exception("Failed to replay spooled Context Broker writes")
+                self.next_replay = time.monotonic() + self.retry_interval
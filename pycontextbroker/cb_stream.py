@@ -0,0 +1,209 @@
+"""Incremental parsing of JSON array responses, and paging through limit/offset listings.
+
+``JSONArrayParser`` is fed the body of a response chunk by chunk and hands
+back each element of the top-level array as soon as it is complete, so
+only the current chunk and element are held in memory, however long the
+array is.
+"""
+import asyncio
+import codecs
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .cb_json import loads
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the socket at a time when streaming a response
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]'
+
+
+class JSONArrayParser(object):
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.started = False
+        self.finished = False
+        # After an element only ',' or ']' may follow
+        self.after_element = False
+
+    def feed(self, chunk):
+        """Add a chunk (bytes or str) of the body, returns the elements it completed."""
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+        elements = []
+        while True:
+            pos = self._skip_whitespace()
+            if pos == len(self.buffer):
+                break
+
+            char = self.buffer[pos]
+            if self.finished:
+                raise ValueError("Unexpected data after the JSON array: {!r}".format(self.buffer[pos:pos + 20]))
+            if not self.started:
+                if char != '[':
+                    raise ValueError("Expected a JSON array, got {!r}".format(self.buffer[pos:pos + 20]))
+                self.started = True
+                self.pos = pos + 1
+                continue
+            if char == ']':
+                self.finished = True
+                self.pos = pos + 1
+                continue
+            if self.after_element:
+                if char != ',':
+                    raise ValueError("Expected ',' or ']' in JSON array, got {!r}".format(char))
+                self.after_element = False
+                self.pos = pos + 1
+                continue
+
+            try:
+                element, end = self.decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                # Most likely an element cut in half by the chunk boundary, wait for the rest
+                break
+            if end == len(self.buffer) or self.buffer[end] not in _DELIMITERS:
+                # A number cut by the chunk boundary ('12' of '12.5') parses too, wait until it is delimited
+                break
+            elements.append(element)
+            self.after_element = True
+            self.pos = end
+        return elements
+
+    def close(self):
+        """Signal the end of the body, returns the last elements or raises ValueError if it was cut short."""
+        elements = self.feed(self.text_decoder.decode(b'', final=True) + ' ')
+        if not self.finished:
+            raise ValueError("Truncated JSON array: {!r}".format(self.buffer[self.pos:self.pos + 20]))
+        return elements
+
+    def _skip_whitespace(self):
+        pos = self.pos
+        while pos < len(self.buffer) and self.buffer[pos] in _WHITESPACE:
+            pos += 1
+        self.pos = pos
+        return pos
+
+
+def iter_array(chunks):
+    """Yield the elements of the JSON array whose body is split in ``chunks``, one at a time."""
+    parser = JSONArrayParser()
+    for chunk in chunks:
+        for element in parser.feed(chunk):
+            yield element
+    for element in parser.close():
+        yield element
+
+
+async def aiter_array(chunks):
+    """asyncio variant of ``iter_array``, over an async iterable of chunks."""
+    parser = JSONArrayParser()
+    async for chunk in chunks:
+        for element in parser.feed(chunk):
+            yield element
+    for element in parser.close():
+        yield element
+
+
+def iter_response(response):
+    """Yield the elements of a JSON array ``requests`` response opened with ``stream=True``, then release it."""
+    try:
+        if response.status_code != 200:
+            logger.error("Failed to stream Orion Context Broker response: %s", loads(response.content))
+            return
+        for element in iter_array(response.iter_content(CHUNK_SIZE)):
+            yield element
+    finally:
+        response.close()
+
+
+def items_from_response(response, kind):
+    """The items of a listing response, an empty list (logged) when the broker answered with an error."""
+    if not isinstance(response, list):
+        logger.error("Failed to list Orion Context Broker %s: %s", kind, response)
+        return []
+    return response
+
+
+def has_next_page(items, page_size, offset, total):
+    if len(items) < page_size:
+        return False
+    return total is None or offset < int(total)
+
+
+def iter_paged(list_page, page_size, prefetch=True):
+    """Yield every item of a limit/offset listing, ``list_page(offset)`` returns (items, total or None) of a page.
+
+    With ``prefetch`` the next page is fetched in the background while the
+    current one is consumed.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        offset = 0
+        items, total = list_page(offset)
+        while True:
+            offset += len(items)
+            next_page = has_next_page(items, page_size, offset, total)
+            prefetched = executor.submit(list_page, offset) if next_page and prefetch else None
+
+            for item in items:
+                yield item
+
+            if not next_page:
+                return
+            items, total = prefetched.result() if prefetched is not None else list_page(offset)
+
+
+async def aiter_paged(list_page, page_size, prefetch=True):
+    """asyncio variant of ``iter_paged``, ``list_page(offset)`` is a coroutine."""
+    offset = 0
+    items, total = await list_page(offset)
+    while True:
+        offset += len(items)
+        next_page = has_next_page(items, page_size, offset, total)
+        prefetched = asyncio.ensure_future(list_page(offset)) if next_page and prefetch else None
+
+        for item in items:
+            yield item
+
+        if not next_page:
+            return
+        items, total = await prefetched if prefetched is not None else await list_page(offset)
+
+
+def iter_pages(connection, page_request, page_size):
+    """Stream every page of a limit/offset listing, ``page_request(offset)`` builds the request of each page."""
+    offset = 0
+    while True:
+        response = connection.request(*page_request(offset), stream=True)
+        total = response.headers.get('Fiware-Total-Count')
+        count = 0
+        for element in iter_response(response):
+            count += 1
+            yield element
+
+        offset += count
+        if count < page_size or (total is not None and offset >= int(total)):
+            return
+
+
+async def aiter_pages(connection, page_request, page_size):
+    """asyncio variant of ``iter_pages``, over ``connection.stream``."""
+    offset = 0
+    while True:
+        count = 0
+        async for element in connection.stream(*page_request(offset)):
+            count += 1
+            yield element
+
+        offset += count
+        if count < page_size:
+            return
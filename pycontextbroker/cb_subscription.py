@@ -1,49 +1,136 @@
-import json
-import requests
+from urllib.parse import urlencode
+
+from .cb_connection import ContextBrokerConnection
+from .cb_json import dumps, loads
+from .cb_stream import items_from_response, iter_paged, iter_pages, iter_response
+
+DEFAULT_DURATION = "P1M"
+DEFAULT_THROTTLING = "PT5S"
 
 
 class ContextBrokerSubscription(object):
-    def __init__(self, cb_address):
+    def __init__(self, cb_address, connection=None):
         self.cb_subscription_endpoint = cb_address + '/v1/subscribeContext'
+        self.cb_subscription_update_endpoint = cb_address + '/v1/updateContextSubscription'
         self.cb_subscriptions_endpoint_v2 = cb_address + '/v2/subscriptions'
         self.cb_unsubscription_endpoint = cb_address + '/v1/unsubscribeContext'
+        self.connection = connection or ContextBrokerConnection()
+
+    def all(self, stream=False):
+        """Subscriptions as a list, or with ``stream`` a generator parsing them while the response comes in."""
+        if stream:
+            return iter_response(self.connection.request(*self._all_request(), stream=True))
+        return loads(self.connection.request(*self._all_request()).content)
+
+    def iter(self, page_size=100, prefetch=True, stream=False):
+        """Lazily yield every subscription (in NGSIv2 format), one page of ``page_size`` at a time."""
+        if stream:
+            for subscription in iter_pages(self.connection, lambda offset: self._list_request(page_size, offset),
+                                           page_size):
+                yield subscription
+            return
+
+        for subscription in iter_paged(lambda offset: self._list_page(page_size, offset), page_size, prefetch):
+            yield subscription
+
+    def on_change(self, entity_type, entity_id, attribute_name, subscriber_endpoint, duration=DEFAULT_DURATION,
+                  throttling=DEFAULT_THROTTLING):
+        return loads(self.connection.request(
+            *self._on_change_request(entity_type, entity_id, attribute_name, subscriber_endpoint, duration, throttling)
+        ).content)
+
+    def on_change_pattern(self, entity_type, id_pattern, attribute_names, subscriber_endpoint,
+                          duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING):
+        """One subscription for every entity of ``entity_type`` whose id matches ``id_pattern``."""
+        return loads(self.connection.request(
+            *self._pattern_request(entity_type, id_pattern, attribute_names, subscriber_endpoint, duration, throttling)
+        ).content)
+
+    def on_type_change(self, entity_type, attribute_names, subscriber_endpoint, duration=DEFAULT_DURATION,
+                       throttling=DEFAULT_THROTTLING):
+        return self.on_change_pattern(entity_type, '.*', attribute_names, subscriber_endpoint, duration, throttling)
+
+    def on_change_many(self, entities, attribute_names, subscriber_endpoint, duration=DEFAULT_DURATION,
+                       throttling=DEFAULT_THROTTLING, chunk_size=100):
+        """Subscribe to many (entity_type, entity_id) pairs with one subscription per ``chunk_size`` entities."""
+        return [
+            loads(self.connection.request(*request).content)
+            for request in self._many_requests(entities, attribute_names, subscriber_endpoint, duration, throttling,
+                                               chunk_size)
+        ]
+
+    def update(self, subscription_id, duration=None, throttling=None):
+        """Change the duration (which renews the subscription) or throttling of a subscription."""
+        return loads(self.connection.request(*self._update_request(subscription_id, duration, throttling)).content)
+
+    def unsubscribe(self, subscription_id):
+        return loads(self.connection.request(*self._unsubscribe_request(subscription_id)).content)
+
+    def _list_page(self, limit, offset):
+        response = self.connection.request(*self._list_request(limit, offset))
+        return items_from_response(loads(response.content), 'subscriptions'), \
+            response.headers.get('Fiware-Total-Count')
 
-    def all(self):
-        return requests.get(self.cb_subscriptions_endpoint_v2).json()
+    # Requests, shared with the asyncio client
+    def _all_request(self):
+        return 'GET', self.cb_subscriptions_endpoint_v2, None, 'subscription.all'
+
+    def _list_request(self, limit, offset):
+        params = urlencode([('limit', limit), ('offset', offset), ('options', 'count')])
+        return 'GET', '{}?{}'.format(self.cb_subscriptions_endpoint_v2, params), None, 'subscription.list'
+
+    def _on_change_request(self, entity_type, entity_id, attribute_name, subscriber_endpoint,
+                           duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING):
+        entities = [{"type": entity_type, "isPattern": "false", "id": entity_id}]
+        return self._subscribe_request(entities, attribute_name, subscriber_endpoint, duration, throttling)
+
+    def _pattern_request(self, entity_type, id_pattern, attribute_names, subscriber_endpoint,
+                         duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING):
+        entities = [{"type": entity_type, "isPattern": "true", "id": id_pattern}]
+        return self._subscribe_request(entities, attribute_names, subscriber_endpoint, duration, throttling)
+
+    def _many_requests(self, entities, attribute_names, subscriber_endpoint, duration=DEFAULT_DURATION,
+                       throttling=DEFAULT_THROTTLING, chunk_size=100):
+        entities = [{"type": entity_type, "isPattern": "false", "id": entity_id} for entity_type, entity_id in entities]
+        return [
+            self._subscribe_request(entities[start:start + chunk_size], attribute_names, subscriber_endpoint,
+                                    duration, throttling)
+            for start in range(0, len(entities), chunk_size)
+        ]
+
+    def _subscribe_request(self, entities, attribute_names, subscriber_endpoint, duration, throttling):
+        if isinstance(attribute_names, str):
+            attribute_names = [attribute_names]
 
-    def on_change(self, entity_type, entity_id, attribute_name, subscriber_endpoint):
         subscription_data = {
-            "entities": [
-                {
-                    "type": entity_type,
-                    "isPattern": "false",
-                    "id": entity_id
-                }
-            ],
-            "attributes": [
-                attribute_name
-            ],
+            "entities": entities,
+            "attributes": list(attribute_names),
             "reference": subscriber_endpoint,
-            "duration": "P1M",
+            "duration": duration,
             "notifyConditions": [
                 {
                     "type": "ONCHANGE",
-                    "condValues": [
-                        attribute_name
-                    ]
+                    "condValues": list(attribute_names)
                 }
-            ],
-            "throttling": "PT5S"
+            ]
         }
+        if throttling:
+            subscription_data["throttling"] = throttling
 
-        return requests.post(self.cb_subscription_endpoint,
-                             data=json.dumps(subscription_data),
-                             headers={'Content-Type': 'application/json'}).json()
+        return 'POST', self.cb_subscription_endpoint, dumps(subscription_data), 'subscription.subscribe'
 
-    def unsubscribe(self, subscription_id):
+    def _update_request(self, subscription_id, duration=None, throttling=None):
+        data = {
+            "subscriptionId": subscription_id
+        }
+        if duration:
+            data["duration"] = duration
+        if throttling:
+            data["throttling"] = throttling
+        return 'POST', self.cb_subscription_update_endpoint, dumps(data), 'subscription.update'
+
+    def _unsubscribe_request(self, subscription_id):
         data = {
             "subscriptionId": subscription_id
         }
-        return requests.post(self.cb_unsubscription_endpoint,
-                             data=json.dumps(data),
-                             headers={'Content-Type': 'application/json'}).json()
+        return 'POST', self.cb_unsubscription_endpoint, dumps(data), 'subscription.unsubscribe'
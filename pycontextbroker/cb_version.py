@@ -0,0 +1,56 @@
+import re
+import threading
+import time
+
+# NGSIv2 became stable in Orion 1.0.0
+V2_MIN_VERSION = (1, 0, 0)
+
+
+def parse_version(version):
+    """'1.2.0-next' -> (1, 2, 0), None if the version can't be read."""
+    match = re.match(r'^(\d+)\.(\d+)(?:\.(\d+))?', version or '')
+    if not match:
+        return None
+    return tuple(int(part or 0) for part in match.groups())
+
+
+class ContextBrokerVersion(object):
+    """Holds the broker's /version response for ``ttl`` seconds, along with the capabilities it implies."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.data = None
+        self.fetched_at = None
+        self.failed_at = None
+        self.lock = threading.Lock()
+
+    def cached(self):
+        with self.lock:
+            if self.data is None or (self.ttl is not None and time.monotonic() - self.fetched_at > self.ttl):
+                return None
+            return self.data
+
+    def store(self, version_data):
+        """Cache a /version response, or with an unusable one (or None for a failed lookup) remember the failure."""
+        with self.lock:
+            if (version_data or {}).get('orion'):
+                self.data = version_data
+                self.fetched_at = time.monotonic()
+                self.failed_at = None
+            else:
+                self.failed_at = time.monotonic()
+
+    def capabilities(self):
+        data = self.cached()
+        if data is None:
+            # A failed lookup counts as no NGSIv2 for the TTL, so the broker is not asked again on every call
+            with self.lock:
+                failed = self.failed_at is not None and (self.ttl is None or
+                                                         time.monotonic() - self.failed_at <= self.ttl)
+            return {"version": None, "v2": False} if failed else None
+        version = data['orion'].get('version')
+        parsed = parse_version(version)
+        return {
+            "version": version,
+            "v2": parsed is not None and parsed >= V2_MIN_VERSION
+        }
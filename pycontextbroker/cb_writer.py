@@ -0,0 +1,138 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter(object):
+    """Collects attribute updates in memory and writes them as batch APPEND requests.
+
+    Updates are coalesced last-write-wins per (entity_type, entity_id,
+    attribute_name), so only the latest value of each attribute is sent. A
+    background thread flushes the buffer every ``flush_interval`` seconds, or
+    as soon as ``max_pending`` attributes are waiting. With ``max_buffer``
+    set, updates to new attributes are dropped while the buffer is full.
+    """
+
+    def __init__(self, batch, max_pending=1000, flush_interval=1.0, max_buffer=None):
+        self.batch = batch
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.pending = OrderedDict()
+        self.pending_count = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update_value(self, entity_type, entity_id, attribute_name, attribute_value, attribute_type=None,
+                     metadatas=None):
+        attribute_data = {"name": attribute_name, "value": attribute_value}
+        if attribute_type:
+            attribute_data['type'] = attribute_type
+        if metadatas:
+            attribute_data['metadatas'] = metadatas
+
+        with self.lock:
+            self.submitted += 1
+            attributes = self.pending.get((entity_type, entity_id))
+            is_new = attributes is None or attribute_name not in attributes
+            if self.closed or (is_new and self._full()):
+                self.dropped += 1
+                return False
+
+            if attributes is None:
+                attributes = self.pending[(entity_type, entity_id)] = OrderedDict()
+            if is_new:
+                self.pending_count += 1
+            else:
+                self.coalesced += 1
+            attributes[attribute_name] = attribute_data
+
+            if self.pending_count >= self.max_pending:
+                self.wake.set()
+        return True
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.pending_count = self.pending, OrderedDict(), 0
+            if not pending:
+                return []
+
+            updates = [
+                (entity_type, entity_id, list(attributes.values()))
+                for (entity_type, entity_id), attributes in pending.items()
+            ]
+            try:
+                results = self.batch.update(updates)
+            except Exception:
+                self._requeue(pending)
+                raise
+
+            failed = sum(len(pending[(r['type'], r['id'])]) for r in results
+                         if (r.get('statusCode') or {}).get('code') != '200')
+            with self.lock:
+                self.flushes += 1
+                self.failed += failed
+                self.written += sum(len(attributes) for attributes in pending.values()) - failed
+            return results
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending_count,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "written": self.written,
+                "failed": self.failed,
+                "flushes": self.flushes
+            }
+
+    def _full(self):
+        return self.max_buffer is not None and self.pending_count >= self.max_buffer
+
+    def _requeue(self, pending):
+        # Put back what could not be sent, unless a newer value arrived meanwhile
+        with self.lock:
+            for key, attributes in pending.items():
+                current = self.pending.setdefault(key, OrderedDict())
+                for attribute_name, attribute_data in attributes.items():
+                    if attribute_name not in current:
+                        current[attribute_name] = attribute_data
+                        self.pending_count += 1
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered Context Broker updates, retrying on next flush")
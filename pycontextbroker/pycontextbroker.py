@@ -1,40 +1,133 @@
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor
+
 from pycontextbroker.cb_attribute import ContextBrokerAttribute
+from pycontextbroker.cb_batch import ContextBrokerBatch
+from pycontextbroker.cb_connection import ContextBrokerConnection
 from pycontextbroker.cb_entity import ContextBrokerEntity
+from pycontextbroker.cb_json import loads
+from pycontextbroker.cb_metrics import ContextBrokerMetrics
+from pycontextbroker.cb_router import LEAST_OUTSTANDING, ContextBrokerRouter
+from pycontextbroker.cb_spool import WriteSpool
 from pycontextbroker.cb_subscription import ContextBrokerSubscription
+from pycontextbroker.cb_version import ContextBrokerVersion
+from pycontextbroker.cb_writer import BufferedWriter
 
 logger = logging.getLogger(__name__)
 
 
 class ContextBrokerClient(object):
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, pool_size=10, keep_alive=True, timeout=None, headers=None, attribute_upsert=False,
+                 cache=None, metrics=None, resilience=None, nodes=None, balance=LEAST_OUTSTANDING, pin_writes=False,
+                 health_interval=5.0, compress_requests=False, version_ttl=60, prefer_v2=False,
+                 health_check_timeout=None):
         self.cb_address = 'http://{}:{}'.format(ip, port)
-        self.entity = ContextBrokerEntity(self.cb_address)
-        self.attribute = ContextBrokerAttribute(self.cb_address)
-        self.subscription = ContextBrokerSubscription(self.cb_address)
+        self.metrics = metrics or ContextBrokerMetrics()
+        self.router = None
+        if nodes:
+            self.router = ContextBrokerRouter([self.cb_address] + list(nodes), balance=balance, pin_writes=pin_writes,
+                                              health_interval=health_interval)
+        self.connection = ContextBrokerConnection(
+            pool_size=pool_size,
+            keep_alive=keep_alive,
+            timeout=timeout,
+            headers=headers,
+            metrics=self.metrics,
+            resilience=resilience,
+            router=self.router,
+            compress_requests=compress_requests
+        )
+        self.cache = cache
+        self.version = ContextBrokerVersion(ttl=version_ttl)
+        self.entity = ContextBrokerEntity(self.cb_address, self.connection, cache)
+        self.attribute = ContextBrokerAttribute(self.cb_address, self.connection, upsert=attribute_upsert, cache=cache,
+                                                prefer_v2=prefer_v2, capabilities=self.get_capabilities)
+        self.subscription = ContextBrokerSubscription(self.cb_address, self.connection)
+        self.batch = ContextBrokerBatch(self.cb_address, self.connection, cache=cache)
+
+        # Nothing is sent to the broker on construction, the health check is opt-in and runs in the background
+        self.executor = None
+        self.health = None
+        if health_check_timeout is not None:
+            self.health = self.health_check(timeout=health_check_timeout, background=True)
+
+    def health_check(self, timeout=2.0, background=False):
+        """Check that the broker answers within ``timeout`` seconds.
+
+        Returns True or False, or a Future resolving to it with ``background``.
+        """
+        if background:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            return self.executor.submit(self.health_check, timeout)
 
         try:
-            requests.get(self.cb_address)
-        except:
+            return bool(self.get_version_data(refresh=True, timeout=timeout).get('orion'))
+        except Exception:
             logger.exception(
                 "Failed to initialize ContextBroker client: "
                 "connection refused, please check provided IP and PORT"
             )
+            return False
+
+    def buffered_writer(self, max_pending=1000, flush_interval=1.0, max_buffer=None):
+        return BufferedWriter(self.batch, max_pending=max_pending, flush_interval=flush_interval, max_buffer=max_buffer)
+
+    def write_spool(self, path, max_size=64 * 1024 * 1024, sync_interval=0.5, sync_every=1000, batch_size=100,
+                    max_rate=None, retry_interval=5.0, write_timeout=None):
+        return WriteSpool(self.batch, path, max_size=max_size, sync_interval=sync_interval, sync_every=sync_every,
+                          batch_size=batch_size, max_rate=max_rate, retry_interval=retry_interval,
+                          write_timeout=write_timeout)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     # Context Broker
-    def get_version_data(self):
-        return requests.get(self.cb_address + '/version').json()
+    def get_version_data(self, refresh=False, timeout=None):
+        version_data = None if refresh else self.version.cached()
+        if version_data is None:
+            kwargs = {'timeout': timeout} if timeout is not None else {}
+            response = self.connection.get(self.cb_address + '/version', operation='version', **kwargs)
+            version_data = loads(response.content)
+            self.version.store(version_data)
+        return version_data
+
+    def get_capabilities(self):
+        """{"version": ..., "v2": bool} derived from the cached /version response.
+
+        After a failed lookup v2 is False until the cache TTL has passed.
+        """
+        if self.version.capabilities() is None:
+            try:
+                self.get_version_data()
+            except Exception:
+                self.version.store(None)
+                raise
+        return self.version.capabilities()
 
     def get_orion_version_data(self):
-        orion_data = self.get_version_data().get('orion')
-        if not orion_data:
-            logger.exception("Failed to gather Orion Context Broker version data")
-        return orion_data
+        return self._orion_data(self.get_version_data(), self.metrics)
 
     def get_version(self):
         return self.get_orion_version_data().get('version')
 
     def get_uptime(self):
         return self.get_orion_version_data().get('uptime')
+
+    @staticmethod
+    def _orion_data(version_data, metrics=None):
+        orion_data = version_data.get('orion')
+        if not orion_data:
+            logger.exception("Failed to gather Orion Context Broker version data")
+            if metrics is not None:
+                metrics.record_error('version')
+        return orion_data
@@ -0,0 +1,479 @@
+"""In-process stand-in for Orion Context Broker.
+
+Implements the NGSIv1 and NGSIv2 endpoints used by pycontextbroker on top of
+an in-memory store, with an optional artificial latency per request, so the
+test suite and the benchmarks can run without a live broker. Like a
+compressing proxy in front of Orion, it inflates gzip request bodies and,
+with ``compress``, gzips responses for clients that accept it.
+"""
+import gzip
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+OK = {"code": "200", "reasonPhrase": "OK"}
+NOT_FOUND = {"code": "404", "reasonPhrase": "No context element found"}
+
+
+def _v1_value(value):
+    if isinstance(value, (dict, list)) or value is None:
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return '{}'.format(value)
+
+
+class FakeOrionStore(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entities = OrderedDict()
+        self.subscriptions = OrderedDict()
+
+    def v1_element(self, key, attribute_names=None):
+        element = {"type": key[0], "isPattern": "false", "id": key[1]}
+        attributes = [
+            self.v1_attribute(attribute) for name, attribute in self.entities[key].items()
+            if not attribute_names or name in attribute_names
+        ]
+        if attributes:
+            element["attributes"] = attributes
+        return element
+
+    @staticmethod
+    def v1_attribute(attribute):
+        rendered = {"name": attribute["name"], "type": attribute["type"], "value": _v1_value(attribute["value"])}
+        if attribute.get("metadatas"):
+            rendered["metadatas"] = attribute["metadatas"]
+        return rendered
+
+    def v2_entity(self, key, attribute_names=None, options=None):
+        options = (options or '').split(',')
+        entity = OrderedDict([("id", key[1]), ("type", key[0])])
+        for name, attribute in self.entities[key].items():
+            if attribute_names and name not in attribute_names:
+                continue
+            if 'keyValues' in options or 'values' in options:
+                entity[name] = attribute["value"]
+            else:
+                metadata = dict((m["name"], {"type": m.get("type"), "value": m.get("value")})
+                                for m in attribute.get("metadatas") or [])
+                entity[name] = {"type": attribute["type"], "value": attribute["value"], "metadata": metadata}
+        if 'values' in options:
+            return [value for name, value in entity.items() if name not in ('id', 'type')]
+        return entity
+
+    def append(self, key, attributes):
+        entity = self.entities.setdefault(key, OrderedDict())
+        for attribute in attributes or []:
+            stored = entity.setdefault(attribute["name"], {"name": attribute["name"], "type": "", "value": ""})
+            if attribute.get("type"):
+                stored["type"] = attribute["type"]
+            if "value" in attribute:
+                stored["value"] = attribute["value"]
+            if attribute.get("metadatas") is not None:
+                stored["metadatas"] = attribute["metadatas"]
+
+
+class FakeOrionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if raw and self.headers.get('Content-Encoding') == 'gzip':
+            self.server.compressed_requests += 1
+            raw = gzip.decompress(raw)
+        return json.loads(raw.decode('utf-8')) if raw else {}
+
+    def _reply(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.compress and len(body) >= 1024 and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        parsed = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        body = self._body() if method in ('POST', 'PUT', 'PATCH') else {}
+        for pattern_method, pattern, handler in ROUTES:
+            match = re.match(pattern + '$', parsed.path)
+            if match and pattern_method == method:
+                with self.store.lock:
+                    return handler(self, query, body, *match.groups())
+        self._reply({"error": "BadRequest", "description": "service not found"}, 400)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    # /version
+    def version(self, query, body):
+        uptime = int(time.time() - self.server.started)
+        self._reply({"orion": {"version": "1.2.0", "uptime": "0 d, 0 h, 0 m, {} s".format(uptime),
+                               "git_hash": "fake", "compile_time": "", "compiled_by": "", "compiled_in": ""}})
+
+    # NGSIv1 convenience operations
+    def v1_create(self, query, body):
+        key = (body.get("type"), body.get("id"))
+        self.store.append(key, body.get("attributes"))
+        return self._v1_append_response(key, body.get("attributes"))
+
+    def v1_get(self, query, body, entity_type, entity_id):
+        key = (entity_type, entity_id)
+        if key not in self.store.entities:
+            return self._reply({"contextElement": {"type": entity_type, "isPattern": "false", "id": entity_id},
+                                "statusCode": dict(NOT_FOUND, details="Entity id: /{}/".format(entity_id))})
+        self._reply({"contextElement": self.store.v1_element(key), "statusCode": OK})
+
+    def v1_append(self, query, body, entity_type, entity_id):
+        key = (entity_type, entity_id)
+        self.store.append(key, body.get("attributes"))
+        return self._v1_append_response(key, body.get("attributes"))
+
+    def _v1_append_response(self, key, attributes):
+        response = {"statusCode": OK}
+        if attributes:
+            response["attributes"] = [dict(a, value="") for a in attributes]
+        self._reply({"contextResponses": [response], "id": key[1], "isPattern": "false", "type": key[0]})
+
+    def v1_delete(self, query, body, entity_type, entity_id):
+        if self.store.entities.pop((entity_type, entity_id), None) is None:
+            return self._reply(NOT_FOUND)
+        self._reply(OK)
+
+    def v1_get_attribute(self, query, body, entity_type, entity_id, name):
+        attribute = self.store.entities.get((entity_type, entity_id), {}).get(name)
+        if attribute is None:
+            return self._reply({"statusCode": NOT_FOUND})
+        self._reply({"attributes": [self.store.v1_attribute(attribute)], "statusCode": OK})
+
+    def v1_update_attribute(self, query, body, entity_type, entity_id, name):
+        attribute = self.store.entities.get((entity_type, entity_id), {}).get(name)
+        if attribute is None:
+            return self._reply(NOT_FOUND)
+        if "value" in body:
+            attribute["value"] = body["value"]
+        if body.get("metadatas") is not None:
+            attribute["metadatas"] = body["metadatas"]
+        self._reply(OK)
+
+    def v1_delete_attribute(self, query, body, entity_type, entity_id, name):
+        if self.store.entities.get((entity_type, entity_id), {}).pop(name, None) is None:
+            return self._reply(NOT_FOUND)
+        self._reply(OK)
+
+    # NGSIv1 standard operations
+    def v1_update_context(self, query, body):
+        action = (body.get("updateAction") or "").upper()
+        responses = []
+        for element in body.get("contextElements") or []:
+            key = (element.get("type"), element.get("id"))
+            attributes = element.get("attributes") or []
+            status = OK
+            if action == "APPEND":
+                self.store.append(key, attributes)
+            elif action == "UPDATE":
+                if key not in self.store.entities or \
+                        any(a["name"] not in self.store.entities[key] for a in attributes):
+                    status = NOT_FOUND
+                else:
+                    self.store.append(key, attributes)
+            elif action == "DELETE":
+                if key not in self.store.entities:
+                    status = NOT_FOUND
+                elif attributes:
+                    for attribute in attributes:
+                        self.store.entities[key].pop(attribute["name"], None)
+                else:
+                    del self.store.entities[key]
+            else:
+                return self._reply({"errorCode": {"code": "400", "reasonPhrase": "Bad Request",
+                                                  "details": "invalid update action"}})
+            rendered = {"type": key[0], "isPattern": "false", "id": key[1]}
+            if attributes:
+                rendered["attributes"] = [dict(a, value="") for a in attributes]
+            responses.append({"contextElement": rendered, "statusCode": status})
+        self._reply({"contextResponses": responses})
+
+    def v1_query_context(self, query, body):
+        attribute_names = body.get("attributes")
+        responses = []
+        for entity in body.get("entities") or []:
+            if entity.get("isPattern") in ("true", True):
+                pattern = re.compile(entity.get("id") or ".*")
+                keys = [key for key in self.store.entities
+                        if pattern.search(key[1]) and (not entity.get("type") or key[0] == entity.get("type"))]
+            else:
+                key = (entity.get("type"), entity.get("id"))
+                keys = [key] if key in self.store.entities else []
+            for key in keys:
+                responses.append({"contextElement": self.store.v1_element(key, attribute_names), "statusCode": OK})
+        if not responses:
+            return self._reply({"errorCode": NOT_FOUND})
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        self._reply({"contextResponses": responses[offset:offset + limit]})
+
+    def v1_subscribe(self, query, body):
+        subscription_id = uuid.uuid4().hex[:24]
+        self.store.subscriptions[subscription_id] = body
+        self._reply({"subscribeResponse": {"subscriptionId": subscription_id,
+                                           "duration": body.get("duration", "P1M"),
+                                           "throttling": body.get("throttling", "PT0S")}})
+
+    def v1_update_subscription(self, query, body):
+        subscription_id = body.get("subscriptionId")
+        if subscription_id not in self.store.subscriptions:
+            return self._reply({"subscribeError": {"subscriptionId": subscription_id, "errorCode": NOT_FOUND}})
+        self.store.subscriptions[subscription_id].update(
+            dict((k, v) for k, v in body.items() if k != "subscriptionId"))
+        self._reply({"subscribeResponse": {"subscriptionId": subscription_id,
+                                           "duration": self.store.subscriptions[subscription_id].get("duration")}})
+
+    def v1_unsubscribe(self, query, body):
+        subscription_id = body.get("subscriptionId") or ""
+        if not re.match(r'^[0-9a-f]{24}$', subscription_id):
+            return self._reply({"subscriptionId": subscription_id,
+                                "statusCode": {"code": "400", "reasonPhrase": "Bad Request",
+                                               "details": "invalid OID mimeType"}})
+        if self.store.subscriptions.pop(subscription_id, None) is None:
+            return self._reply({"subscriptionId": subscription_id, "statusCode": NOT_FOUND})
+        self._reply({"subscriptionId": subscription_id, "statusCode": OK})
+
+    # NGSIv2
+    def v2_entities(self, query, body):
+        keys = [key for key in self.store.entities
+                if (not query.get("type") or key[0] == query["type"]) and
+                (not query.get("idPattern") or re.search(query["idPattern"], key[1])) and
+                (not query.get("id") or key[1] in query["id"].split(','))]
+        keys = [key for key in keys
+                if self._v2_matches(key, query.get("q")) and self._v2_matches_metadata(key, query.get("mq"))]
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        attribute_names = query["attrs"].split(',') if query.get("attrs") else None
+        entities = [self.store.v2_entity(key, attribute_names, query.get("options"))
+                    for key in keys[offset:offset + limit]]
+        headers = {}
+        if 'count' in (query.get("options") or ''):
+            headers['Fiware-Total-Count'] = str(len(keys))
+        self._reply(entities, headers=headers)
+
+    def _v2_matches(self, key, q):
+        if not q:
+            return True
+        for statement in q.split(';'):
+            match = re.match(r'^(\w+)(==|!=|>=|<=|>|<)(.*)$', statement)
+            if not match:
+                continue
+            name, operator, expected = match.groups()
+            attribute = self.store.entities[key].get(name)
+            if attribute is None:
+                return False
+            actual = '{}'.format(attribute["value"])
+            try:
+                actual, expected = float(actual), float(expected)
+            except ValueError:
+                pass
+            if not {'==': actual == expected, '!=': actual != expected, '>=': actual >= expected,
+                    '<=': actual <= expected, '>': actual > expected, '<': actual < expected}[operator]:
+                return False
+        return True
+
+    def _v2_matches_metadata(self, key, mq):
+        # Only equality on metadata values: <attribute>.<metadata>==<value>
+        for statement in (mq or '').split(';'):
+            match = re.match(r'^(\w+)\.(\w+)==(.*)$', statement)
+            if not match:
+                continue
+            name, metadata_name, expected = match.groups()
+            attribute = self.store.entities[key].get(name) or {}
+            values = dict((m.get("name"), '{}'.format(m.get("value"))) for m in attribute.get("metadatas") or [])
+            if values.get(metadata_name) != expected:
+                return False
+        return True
+
+    def v2_entity(self, query, body, entity_id):
+        keys = [key for key in self.store.entities
+                if key[1] == entity_id and (not query.get("type") or key[0] == query["type"])]
+        if not keys:
+            return self._reply({"error": "NotFound",
+                                "description": "The requested entity has not been found. Check type and id"}, 404)
+        attribute_names = query["attrs"].split(',') if query.get("attrs") else None
+        self._reply(self.store.v2_entity(keys[0], attribute_names, query.get("options")))
+
+    def v2_attribute(self, query, body, entity_id, name):
+        attribute = self._v2_find_attribute(query, entity_id, name)
+        if attribute is None:
+            return self._reply({"error": "NotFound",
+                                "description": "The entity does not have such an attribute"}, 404)
+        self._reply({"type": attribute.get("type"), "value": attribute["value"], "metadata": {}})
+
+    def v2_attribute_value(self, query, body, entity_id, name):
+        attribute = self._v2_find_attribute(query, entity_id, name)
+        if attribute is None:
+            return self._reply({"error": "NotFound",
+                                "description": "The entity does not have such an attribute"}, 404)
+        self._reply(attribute["value"])
+
+    def _v2_find_attribute(self, query, entity_id, name):
+        keys = [key for key in self.store.entities
+                if key[1] == entity_id and (not query.get("type") or key[0] == query["type"])]
+        if not keys:
+            return None
+        return self.store.entities[keys[0]].get(name)
+
+    def v2_op_update(self, query, body):
+        action = body.get("actionType")
+        for entity in body.get("entities") or []:
+            key = (entity.get("type"), entity.get("id"))
+            attributes = [{"name": name, "type": value.get("type"), "value": value.get("value")}
+                          for name, value in entity.items() if name not in ("id", "type")]
+            if action in ("append", "append_strict", "update", "replace"):
+                self.store.append(key, attributes)
+            elif action == "delete":
+                if attributes and key in self.store.entities:
+                    for attribute in attributes:
+                        self.store.entities[key].pop(attribute["name"], None)
+                else:
+                    self.store.entities.pop(key, None)
+        self._reply(None, 204)
+
+    def v2_op_query(self, query, body):
+        attribute_names = body.get("attrs")
+        entities = []
+        for selector in body.get("entities") or []:
+            for key in self.store.entities:
+                if selector.get("type") and key[0] != selector["type"]:
+                    continue
+                if selector.get("id") and key[1] != selector["id"]:
+                    continue
+                if selector.get("idPattern") and not re.search(selector["idPattern"], key[1]):
+                    continue
+                entities.append(self.store.v2_entity(key, attribute_names, query.get("options")))
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        self._reply(entities[offset:offset + limit])
+
+    def v2_subscriptions(self, query, body):
+        subscriptions = []
+        for subscription_id, data in self.store.subscriptions.items():
+            subscriptions.append({
+                "id": subscription_id,
+                "expires": "2100-01-01T00:00:00.00Z",
+                "status": "active",
+                "subject": {
+                    "entities": [{"idPattern" if e.get("isPattern") == "true" else "id": e.get("id"),
+                                  "type": e.get("type")} for e in data.get("entities") or []],
+                    "condition": {"attributes": [v for c in data.get("notifyConditions") or []
+                                                 for v in c.get("condValues") or []]}
+                },
+                "notification": {"callback": data.get("reference"), "attributes": data.get("attributes") or []},
+                "throttling": data.get("throttling"),
+            })
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        headers = {}
+        if 'count' in (query.get("options") or ''):
+            headers['Fiware-Total-Count'] = str(len(subscriptions))
+        self._reply(subscriptions[offset:offset + limit], headers=headers)
+
+    def root(self, query, body):
+        self._reply({"orion": "fake"})
+
+
+ROUTES = [
+    ('GET', r'/', FakeOrionHandler.root),
+    ('GET', r'/version', FakeOrionHandler.version),
+    ('POST', r'/v1/contextEntities', FakeOrionHandler.v1_create),
+    ('GET', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)', FakeOrionHandler.v1_get),
+    ('POST', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)', FakeOrionHandler.v1_append),
+    ('DELETE', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)', FakeOrionHandler.v1_delete),
+    ('GET', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)/attributes/([^/]+)', FakeOrionHandler.v1_get_attribute),
+    ('PUT', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)/attributes/([^/]+)', FakeOrionHandler.v1_update_attribute),
+    ('DELETE', r'/v1/contextEntities/type/([^/]+)/id/([^/]+)/attributes/([^/]+)',
+     FakeOrionHandler.v1_delete_attribute),
+    ('POST', r'/v1/updateContext', FakeOrionHandler.v1_update_context),
+    ('POST', r'/v1/queryContext', FakeOrionHandler.v1_query_context),
+    ('POST', r'/v1/subscribeContext', FakeOrionHandler.v1_subscribe),
+    ('POST', r'/v1/updateContextSubscription', FakeOrionHandler.v1_update_subscription),
+    ('POST', r'/v1/unsubscribeContext', FakeOrionHandler.v1_unsubscribe),
+    ('GET', r'/v2/entities', FakeOrionHandler.v2_entities),
+    ('GET', r'/v2/entities/([^/]+)', FakeOrionHandler.v2_entity),
+    ('GET', r'/v2/entities/([^/]+)/attrs/([^/]+)', FakeOrionHandler.v2_attribute),
+    ('GET', r'/v2/entities/([^/]+)/attrs/([^/]+)/value', FakeOrionHandler.v2_attribute_value),
+    ('POST', r'/v2/op/update', FakeOrionHandler.v2_op_update),
+    ('POST', r'/v2/op/query', FakeOrionHandler.v2_op_query),
+    ('GET', r'/v2/subscriptions', FakeOrionHandler.v2_subscriptions),
+]
+
+
+class FakeOrionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, compress=False):
+        HTTPServer.__init__(self, (host, port), FakeOrionHandler)
+        self.store = FakeOrionStore()
+        self.latency = latency
+        self.compress = compress
+        self.compressed_requests = 0
+        self.started = time.time()
+        self.thread = None
+
+    @property
+    def ip(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
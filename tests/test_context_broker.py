@@ -1,10 +1,47 @@
+import asyncio
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+
+import requests
+
+from pycontextbroker.cb_cache import EntityCache
+from pycontextbroker.cb_connection import request_unsent
+from pycontextbroker.cb_listener import NotificationListener
+from pycontextbroker.cb_model import Entity
+from pycontextbroker.cb_registry import SubscriptionRegistry, parse_duration
+from pycontextbroker.cb_resilience import CircuitOpenError, ResiliencePolicy
+from pycontextbroker.cb_router import ContextBrokerRouter
+from pycontextbroker.cb_spool import WriteSpool
+from pycontextbroker.cb_stream import iter_array
+from pycontextbroker.cb_version import ContextBrokerVersion
 from pycontextbroker.pycontextbroker import ContextBrokerClient
 
+from fake_orion import FakeOrionServer
+
+try:
+    from pycontextbroker.aiocontextbroker import AsyncContextBrokerClient, aiohttp
+except ImportError:
+    aiohttp = None
+
 CONTEXTBROKER_IP = os.environ.get('CONTEXTBROKER_IP')
 CONTEXTBROKER_PORT = os.environ.get('CONTEXTBROKER_PORT', '1026')
 
+fake_orion = None
+if CONTEXTBROKER_IP is None:
+    # No live broker configured, run against the in-process stand-in
+    fake_orion = FakeOrionServer().start()
+    CONTEXTBROKER_IP, CONTEXTBROKER_PORT = fake_orion.ip, str(fake_orion.port)
+
+
+def tearDownModule():
+    if fake_orion is not None:
+        fake_orion.stop()
+
 
 class PycontextbrokerTestCase(unittest.TestCase):
 
@@ -28,6 +65,105 @@ class PycontextbrokerTestCase(unittest.TestCase):
     def test_get_uptime(self):
         self.assertIsNotNone(self.cbc.get_uptime())
 
+    def test_metrics_snapshot(self):
+        self.cbc.metrics.reset()
+        self.cbc.entity.get("TestSearch", "test_search_1")
+        self.cbc.attribute.get_value("TestSearch", "test_search_1", "number")
+        snapshot = self.cbc.metrics.snapshot()
+        self.assertIn('entity.get', snapshot)
+        self.assertIn('attribute.get', snapshot)
+        self.assertEqual(1, snapshot['entity.get']['count'])
+        self.assertEqual(0, snapshot['entity.get']['in_flight'])
+        self.assertEqual(0, snapshot['entity.get']['errors'])
+        self.assertGreater(snapshot['entity.get']['response_bytes'], 0)
+        self.assertEqual(1, sum(snapshot['entity.get']['latency']['buckets'].values()))
+
+    def test_metrics_hooks(self):
+        calls = []
+        self.cbc.metrics.add_before_hook(lambda call: calls.append(('before', call['operation'])))
+        self.cbc.metrics.add_after_hook(lambda call: calls.append(('after', call['operation'], call['status'])))
+        self.cbc.get_version()
+        self.assertEqual([('before', 'version'), ('after', 'version', 200)], calls)
+
+    def test_metrics_count_bytes_sent(self):
+        body = json.dumps({"contextElements": [{"type": "TestMetrics", "isPattern": "false", "id": "test_metrics_1",
+                                                "attributes": [{"name": "unit", "value": "\u20ac" * 1000}]}],
+                           "updateAction": "APPEND"}, ensure_ascii=False)
+        url = self.cbc.cb_address + '/v1/updateContext'
+        self.cbc.connection.request('POST', url, body, 'batch.update')
+        self.assertEqual(len(body.encode('utf-8')), self.cbc.metrics.snapshot()['batch.update']['request_bytes'])
+        self.assertEqual('\u20ac' * 1000, self.cbc.attribute.get_value("TestMetrics", "test_metrics_1", "unit"))
+
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, compress_requests=True) as cbc:
+            cbc.connection.request('POST', url, body, 'batch.update')
+            self.assertLess(cbc.metrics.snapshot()['batch.update']['request_bytes'], len(body))
+
+    def test_metrics_count_connection_errors(self):
+        cbc = ContextBrokerClient('127.0.0.1', '1')
+        self.assertEqual({}, cbc.metrics.snapshot())
+        self.assertFalse(cbc.health_check(timeout=1))
+        self.assertEqual(1, cbc.metrics.snapshot()['version']['errors'])
+
+    def test_health_check(self):
+        self.assertTrue(self.cbc.health_check())
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, health_check_timeout=2) as cbc:
+            self.assertTrue(cbc.health.result())
+
+    def test_version_is_cached(self):
+        self.cbc.get_version()
+        self.cbc.get_uptime()
+        capabilities = self.cbc.get_capabilities()
+        self.assertEqual(1, self.cbc.metrics.snapshot()['version']['count'])
+        self.assertEqual(self.cbc.get_version(), capabilities['version'])
+        self.assertIn('v2', capabilities)
+
+    def test_get_value_prefer_v2(self):
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, prefer_v2=True) as cbc:
+            if not cbc.get_capabilities()['v2']:
+                self.skipTest("Context Broker does not support NGSIv2")
+            cbc.entity.create("TestSearch", "test_search_v2", attributes=[{"name": "number", "type": "integer", "value": "7"}])
+            self.assertEqual('7', cbc.attribute.get_value("TestSearch", "test_search_v2", "number"))
+            self.assertIsNone(cbc.attribute.get_value("TestSearch", "test_search_v2", "missing"))
+            cbc.entity.delete("TestSearch", "test_search_v2")
+            self.assertIn('attribute.get_v2', cbc.metrics.snapshot())
+
+    def test_prefer_v2_falls_back_to_v1_once(self):
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, prefer_v2=True) as cbc:
+            cbc.entity.create("TestSearch", "test_search_v1",
+                              attributes=[{"name": "number", "type": "integer", "value": "7"}])
+            lookups = []
+            get = cbc.connection.get
+
+            def failing_get(url, **kwargs):
+                if url.endswith('/version'):
+                    lookups.append(url)
+                    raise requests.exceptions.ConnectionError("version lookup failed")
+                return get(url, **kwargs)
+
+            cbc.connection.get = failing_get
+            for _ in range(5):
+                self.assertEqual('7', cbc.attribute.get_value("TestSearch", "test_search_v1", "number"))
+            # The failure is remembered for the TTL rather than probed on every read
+            self.assertEqual(1, len(lookups))
+            self.assertEqual({"version": None, "v2": False}, cbc.get_capabilities())
+            cbc.entity.delete("TestSearch", "test_search_v1")
+
+        version = ContextBrokerVersion(ttl=60)
+        version.store({"error": "unusable"})
+        self.assertFalse(version.capabilities()['v2'])
+        version.store({"orion": {"version": "1.2.0"}})
+        self.assertTrue(version.capabilities()['v2'])
+
+    def test_sub_clients_share_connection(self):
+        self.assertIs(self.cbc.entity.connection, self.cbc.connection)
+        self.assertIs(self.cbc.attribute.connection, self.cbc.connection)
+        self.assertIs(self.cbc.attribute.entity.connection, self.cbc.connection)
+        self.assertIs(self.cbc.subscription.connection, self.cbc.connection)
+
+    def test_client_as_context_manager(self):
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT) as cbc:
+            self.assertIsNotNone(cbc.get_version())
+
     # Entity
     def test_create_entity_without_attributes(self):
         response = self.cbc.entity.create(
@@ -97,6 +233,133 @@ class PycontextbrokerTestCase(unittest.TestCase):
         self.assertEquals('test_search_2', response.get('contextElement').get('id'))
         self.assertEquals('TestSearch', response.get('contextElement').get('type'))
 
+    def test_iter_entities(self):
+        self.cbc.batch.update(("TestIter", "test_iter_{}".format(i), {"number": i}) for i in range(7))
+        entities = list(self.cbc.entity.iter(entity_type="TestIter", page_size=3))
+        self.assertEqual(7, len(entities))
+        self.assertEqual(['test_iter_{}'.format(i) for i in range(7)], [e.get('id') for e in entities])
+        self.assertEqual('TestIter', entities[0].get('type'))
+        self.assertEqual(7, len(list(self.cbc.entity.iter(entity_type="TestIter", page_size=7, prefetch=False))))
+
+    def test_iter_entities_filtered(self):
+        self.cbc.batch.update(("TestFilter", "test_filter_{}".format(i), {"number": i, "other": "x"}) for i in range(6))
+        entities = list(self.cbc.entity.iter(entity_type="TestFilter", page_size=2, q="number>=3", attrs=["number"],
+                                             options="keyValues"))
+        self.assertEqual([{"id": "test_filter_{}".format(i), "type": "TestFilter", "number": i} for i in range(3, 6)],
+                         [dict(entity) for entity in entities])
+        values = list(self.cbc.entity.iter(entity_type="TestFilter", id_pattern="_[01]$", attrs="number",
+                                           options="values"))
+        self.assertEqual([[0], [1]], values)
+
+    def test_iter_entities_metadata_filter(self):
+        metadatas = [{"name": "unit", "type": "string", "value": "celsius"}]
+        self.cbc.entity.create("TestFilterMeta", "test_filter_meta", attributes=[
+            {"name": "temperature", "type": "float", "value": "21.5", "metadatas": metadatas}
+        ])
+        found = list(self.cbc.entity.iter(entity_type="TestFilterMeta", mq="temperature.unit==celsius"))
+        self.assertEqual(["test_filter_meta"], [e["id"] for e in found])
+        self.assertEqual([], list(self.cbc.entity.iter(entity_type="TestFilterMeta", mq="temperature.unit==kelvin")))
+        self.cbc.entity.delete("TestFilterMeta", "test_filter_meta")
+
+    def test_get_v2_projection(self):
+        self.cbc.batch.update([("TestProjection", "test_projection", {"number": 4, "other": "x"})])
+        response = self.cbc.entity.get_v2("TestProjection", "test_projection", attrs=["number"], options="keyValues")
+        self.assertEqual({"id": "test_projection", "type": "TestProjection", "number": 4}, dict(response))
+        self.assertIsNone(self.cbc.entity.get_v2("TestProjection", "test_projection_missing"))
+
+        entity = self.cbc.entity.get_entity("TestProjection", "test_projection", attrs=["other"])
+        self.assertEqual(["other"], list(entity.attributes))
+        self.assertEqual("x", entity.get_value("other"))
+
+    def test_iter_entities_streamed(self):
+        self.cbc.batch.update(("TestStream", "test_stream_{}".format(i), {"number": i}) for i in range(7))
+        expected = list(self.cbc.entity.iter(entity_type="TestStream", page_size=3))
+        self.assertEqual(expected, list(self.cbc.entity.iter(entity_type="TestStream", page_size=3, stream=True)))
+        self.assertEqual(list(self.cbc.subscription.all()), list(self.cbc.subscription.all(stream=True)))
+
+    def test_stream_parser(self):
+        elements = [{"id": "a", "value": 1.25, "text": "], \\\"x\\\" \u00e9"}, 12, [3, {}], None]
+        body = json.dumps(elements, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 5, len(body)):
+            chunks = [body[start:start + size] for start in range(0, len(body), size)]
+            self.assertEqual(elements, list(iter_array(chunks)))
+        with self.assertRaises(ValueError):
+            list(iter_array([b'[1, 2']))
+        with self.assertRaises(ValueError):
+            list(iter_array([b'{"error": "NotFound"}']))
+
+    def test_compressed_transport(self):
+        with FakeOrionServer(compress=True) as server:
+            with ContextBrokerClient(server.ip, server.port, compress_requests=True) as cbc:
+                cbc.batch.update(("TestGzip", "test_gzip_{}".format(i), {"text": "x" * 100}) for i in range(50))
+                self.assertEqual(1, server.compressed_requests)
+                entities = list(cbc.entity.iter(entity_type="TestGzip", page_size=20, stream=True))
+                self.assertEqual(50, len(entities))
+                self.assertEqual(entities, list(cbc.entity.iter(entity_type="TestGzip", page_size=20)))
+                snapshot = cbc.metrics.snapshot()
+                self.assertLess(snapshot['batch.update']['request_bytes'], 50 * 100)
+
+    def test_get_many_entities(self):
+        self.cbc.batch.update(("TestMany", "test_many_{}".format(i), {"number": i, "other": "x"}) for i in range(3))
+        keys = [("TestMany", "test_many_{}".format(i)) for i in range(3)] + [("TestMany", "test_many_missing")]
+        response = self.cbc.entity.get_many(keys)
+        self.assertEqual(set(keys), set(response))
+        self.assertEqual('200', response[("TestMany", "test_many_1")]['statusCode']['code'])
+        self.assertEqual(2, len(response[("TestMany", "test_many_1")]['contextElement']['attributes']))
+        self.assertEqual('404', response[("TestMany", "test_many_missing")]['statusCode']['code'])
+
+    def test_get_many_entities_with_attributes(self):
+        self.cbc.batch.update(("TestMany", "test_many_{}".format(i), {"number": i, "other": "x"}) for i in range(3))
+        keys = [("TestMany", "test_many_{}".format(i)) for i in range(3)]
+        response = self.cbc.entity.get_many(keys, attrs=["number"], chunk_size=2)
+        attributes = response[("TestMany", "test_many_2")]['contextElement']['attributes']
+        self.assertEqual(["number"], [a.get('name') for a in attributes])
+        self.assertEqual('2', attributes[0].get('value'))
+
+    def test_get_many_entities_caps_chunk_size(self):
+        self.cbc.batch.update(("TestManyCap", "test_many_cap_{}".format(i), {"number": i}) for i in range(1200))
+        keys = [("TestManyCap", "test_many_cap_{}".format(i)) for i in range(1200)]
+        queries = self.cbc.metrics.snapshot().get('entity.query', {}).get('count', 0)
+        response = self.cbc.entity.get_many(keys + keys[:10], chunk_size=5000)
+        self.assertEqual(1200, len(response))
+        self.assertTrue(all(result['statusCode']['code'] == '200' for result in response.values()))
+        self.assertEqual(queries + 2, self.cbc.metrics.snapshot()['entity.query']['count'])
+
+    def test_get_typed_entity(self):
+        self.cbc.entity.create("TestModel", "test_model_1", attributes=[
+            {"name": "number", "type": "integer", "value": "1"},
+            {"name": "ratio", "type": "float", "value": "0.5"},
+            {"name": "on", "type": "boolean", "value": "true"},
+            {"name": "label", "type": "string", "value": "one",
+             "metadatas": [{"name": "timestamp", "type": "string", "value": "2016-05-30T15:30:00Z"}]},
+        ])
+        entity = self.cbc.entity.get_entity("TestModel", "test_model_1")
+        self.assertEqual(('TestModel', 'test_model_1'), (entity.type, entity.id))
+        self.assertEqual(1, entity.get_value("number"))
+        self.assertEqual(0.5, entity.get_value("ratio"))
+        self.assertIs(True, entity.get_value("on"))
+        self.assertEqual('one', entity["label"].value)
+        self.assertEqual({"timestamp": "2016-05-30T15:30:00Z"}, entity["label"].metadatas)
+        self.assertNotIn("missing", entity)
+        self.assertIsNone(self.cbc.entity.get_entity("TestModel", "test_model_missing"))
+
+    def test_typed_integer_keeps_fractional_values(self):
+        entity = Entity.from_v2({"id": "e1", "type": "T",
+                                 "whole": {"type": "integer", "value": "22.0"},
+                                 "count": {"type": "Integer", "value": 22.0},
+                                 "reading": {"type": "integer", "value": "22.5"},
+                                 "sample": {"type": "int", "value": 22.5}})
+        self.assertEqual((22, 22), (entity.get_value("whole"), entity.get_value("count")))
+        self.assertIsInstance(entity.get_value("count"), int)
+        # Not a whole number: returned as received rather than truncated
+        self.assertEqual(('22.5', 22.5), (entity.get_value("reading"), entity.get_value("sample")))
+
+    def test_typed_entity_from_v2(self):
+        entity = Entity.from_v2({"id": "e1", "type": "T", "speed": {"type": "Number", "value": "12", "metadata": {"unit": {"type": "Text", "value": "km/h"}}}})
+        self.assertEqual(12, entity.get_value("speed"))
+        self.assertEqual({"unit": "km/h"}, entity.get("speed").metadatas)
+        self.assertEqual(1, len(entity))
+
     # Attributes
     def test_get_attribute_value(self):
         if self.cbc.entity.get("TestSearch", "test_search_1")['statusCode']['code'] == '404':
@@ -175,6 +438,38 @@ class PycontextbrokerTestCase(unittest.TestCase):
                                   ])
         self.assertEqual('33', self.cbc.attribute.get_value("TestSearch", "test_search_2", "new_attribute"))
 
+    def test_upsert_update_value(self):
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, attribute_upsert=True)
+        cbc.attribute.update_value("TestSearch", "test_search_upsert", "number", 5)
+        self.assertEqual('5', cbc.attribute.get_value("TestSearch", "test_search_upsert", "number"))
+        response = cbc.attribute.update_value("TestSearch", "test_search_upsert", "number", 6)
+        # Same answer as the PUT of a non-upsert update of an existing attribute
+        self.assertEqual({"code": "200", "reasonPhrase": "OK"}, response)
+        self.assertEqual('6', cbc.attribute.get_value("TestSearch", "test_search_upsert", "number"))
+        # Created with the "integer" type, as update_value without upsert does
+        self.assertEqual(6, cbc.entity.get_entity("TestSearch", "test_search_upsert").get_value("number"))
+
+    def test_upsert_keeps_attribute_type(self):
+        self.cbc.entity.create("TestSearch", "test_search_upsert_float",
+                               attributes=[{"name": "temperature", "type": "float", "value": "21.5"}])
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, attribute_upsert=True)
+        self.assertEqual({"code": "200", "reasonPhrase": "OK"},
+                         cbc.attribute.update_value("TestSearch", "test_search_upsert_float", "temperature", "22.5"))
+        cbc.attribute.update("TestSearch", "test_search_upsert_float", "temperature", "23.5")
+        attribute = cbc.attribute.get("TestSearch", "test_search_upsert_float", "temperature")
+        self.assertEqual(("float", "23.5"), (attribute.get("type"), attribute.get("value")))
+        cbc.entity.delete("TestSearch", "test_search_upsert_float")
+
+    def test_upsert_create_overwrites_attribute(self):
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, attribute_upsert=True)
+        cbc.attribute.create("TestSearch", "test_search_upsert", "created", 1)
+        cbc.attribute.create("TestSearch", "test_search_upsert", "created", 2)
+        self.assertEqual('2', cbc.attribute.get_value("TestSearch", "test_search_upsert", "created"))
+
+    def test_get_missing_attribute(self):
+        self.assertIsNone(self.cbc.attribute.get("TestSearch", "test_search_missing", "number"))
+        self.assertIsNone(self.cbc.attribute.get_value("TestSearch", "test_search_missing", "number"))
+
     def test_delete_attribute_attribute_value(self):
         self.cbc.attribute.create("TestSearch", "test_search_2", "attribute_to_be_deleted", 66)
         self.assertEqual('66', self.cbc.attribute.get_value("TestSearch", "test_search_2", "attribute_to_be_deleted"))
@@ -192,6 +487,397 @@ class PycontextbrokerTestCase(unittest.TestCase):
         self.cbc.entity.delete("TestSearch", "test_search_2")
         self.assertEquals(self.cbc.entity.get("TestSearch", "test_search_2")['statusCode']['code'], '404')
 
+    # Cache
+    def test_cached_entity_reads(self):
+        cache = EntityCache(max_size=10, ttl=60)
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, cache=cache)
+        cbc.entity.create("TestCache", "test_cache_1", attributes=[{"name": "number", "type": "integer", "value": "1"}])
+        cbc.entity.get("TestCache", "test_cache_1")
+        self.assertEqual('1', cbc.attribute.get_value("TestCache", "test_cache_1", "number"))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 1, "evictions": 0}, cache.stats())
+
+    def test_cache_invalidated_on_write(self):
+        cache = EntityCache(max_size=10, ttl=60)
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, cache=cache)
+        cbc.entity.create("TestCache", "test_cache_2", attributes=[{"name": "number", "type": "integer", "value": "1"}])
+        self.assertEqual('1', cbc.attribute.get_value("TestCache", "test_cache_2", "number"))
+        cbc.attribute.update_value("TestCache", "test_cache_2", "number", 2)
+        self.assertEqual('2', cbc.attribute.get_value("TestCache", "test_cache_2", "number"))
+        cbc.entity.delete("TestCache", "test_cache_2")
+        self.assertEqual('404', cbc.entity.get("TestCache", "test_cache_2")['statusCode']['code'])
+
+    def test_cache_skips_reads_racing_a_write(self):
+        cache = EntityCache(max_size=10)
+        cbc = ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, cache=cache)
+        cbc.entity.create("TestCache", "test_cache_race", attributes=[{"name": "number", "type": "integer", "value": "1"}])
+
+        # The reader gets its answer, then is held back until a writer has updated and invalidated the entity
+        fetched, release = threading.Event(), threading.Event()
+        request = cbc.connection.request
+
+        def held_request(*args, **kwargs):
+            response = request(*args, **kwargs)
+            if threading.current_thread() is reader:
+                fetched.set()
+                release.wait(5)
+            return response
+
+        cbc.connection.request = held_request
+        reader = threading.Thread(target=cbc.entity.get, args=("TestCache", "test_cache_race"))
+        reader.start()
+        self.assertTrue(fetched.wait(5))
+        cbc.attribute.update_value("TestCache", "test_cache_race", "number", 2)
+        release.set()
+        reader.join()
+
+        self.assertEqual(0, len(cache))
+        self.assertEqual('2', cbc.attribute.get_value("TestCache", "test_cache_race", "number"))
+        cbc.entity.delete("TestCache", "test_cache_race")
+
+    def test_cache_lru_eviction_and_ttl(self):
+        cache = EntityCache(max_size=2, ttl=60, type_ttl={"Volatile": 0})
+        cache.set("TestCache", "a", {"id": "a"})
+        cache.set("TestCache", "b", {"id": "b"})
+        cache.get("TestCache", "a")
+        cache.set("TestCache", "c", {"id": "c"})
+        self.assertIsNone(cache.get("TestCache", "b"))
+        self.assertEqual({"id": "a"}, cache.get("TestCache", "a"))
+        self.assertEqual(1, cache.stats().get('evictions'))
+        cache.set("Volatile", "d", {"id": "d"})
+        self.assertIsNone(cache.get("Volatile", "d"))
+
+    # Batch
+    def test_batch_update(self):
+        updates = (("TestBatch", "test_batch_{}".format(i), {"number": i}) for i in range(5))
+        response = self.cbc.batch.update(updates)
+        self.assertEqual(5, len(response))
+        self.assertEqual('test_batch_0', response[0].get('id'))
+        self.assertEqual('200', response[0].get('statusCode').get('code'))
+        self.assertEqual('4', self.cbc.attribute.get_value("TestBatch", "test_batch_4", "number"))
+
+    def test_batch_update_chunked(self):
+        self.cbc.batch.chunk_size = 2
+        updates = [("TestBatch", "test_batch_chunk_{}".format(i), [{"name": "number", "type": "integer", "value": "1"}])
+                   for i in range(5)]
+        response = self.cbc.batch.update(updates)
+        self.assertEqual(['200'] * 5, [r.get('statusCode').get('code') for r in response])
+        response = self.cbc.batch.delete([("TestBatch", "test_batch_chunk_{}".format(i), None) for i in range(5)])
+        self.assertEqual(['200'] * 5, [r.get('statusCode').get('code') for r in response])
+        self.assertEqual(self.cbc.entity.get("TestBatch", "test_batch_chunk_0")['statusCode']['code'], '404')
+
+    # Buffered writer
+    def test_buffered_writer_coalesces_updates(self):
+        with self.cbc.buffered_writer(flush_interval=60) as writer:
+            for value in range(10):
+                writer.update_value("TestBuffered", "test_buffered_1", "number", value)
+            writer.update_value("TestBuffered", "test_buffered_2", "number", 1)
+            self.assertEqual(2, writer.stats().get('pending'))
+        stats = writer.stats()
+        self.assertEqual(9, stats.get('coalesced'))
+        self.assertEqual(2, stats.get('written'))
+        self.assertEqual(1, stats.get('flushes'))
+        self.assertEqual('9', self.cbc.attribute.get_value("TestBuffered", "test_buffered_1", "number"))
+        self.assertFalse(writer.update_value("TestBuffered", "test_buffered_1", "number", 10))
+        self.assertEqual(1, writer.stats().get('dropped'))
+
+    def test_buffered_writer_flushes_on_size(self):
+        writer = self.cbc.buffered_writer(max_pending=3, flush_interval=60)
+        for i in range(3):
+            writer.update_value("TestBuffered", "test_buffered_size_{}".format(i), "number", i)
+        for _ in range(50):
+            if writer.stats().get('written') == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(3, writer.stats().get('written'))
+        writer.close()
+
+    def test_buffered_writer_drops_when_full(self):
+        writer = self.cbc.buffered_writer(max_pending=100, flush_interval=60, max_buffer=1)
+        self.assertTrue(writer.update_value("TestBuffered", "test_buffered_full", "a", 1))
+        self.assertTrue(writer.update_value("TestBuffered", "test_buffered_full", "a", 2))
+        self.assertFalse(writer.update_value("TestBuffered", "test_buffered_full", "b", 1))
+        writer.close()
+        self.assertEqual(1, writer.stats().get('dropped'))
+        self.assertEqual(1, writer.stats().get('coalesced'))
+
+    # Write spool
+    def _spool_path(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return os.path.join(directory, 'spool.log')
+
+    def test_write_spool_sends_directly_while_broker_is_up(self):
+        with self.cbc.write_spool(self._spool_path()) as spool:
+            self.assertTrue(spool.update_value("TestSpool", "test_spool_direct", "number", 1))
+            stats = spool.stats()
+        self.assertEqual(1, stats.get('direct'))
+        self.assertEqual(0, stats.get('pending'))
+        self.assertEqual('1', self.cbc.attribute.get_value("TestSpool", "test_spool_direct", "number"))
+
+    def test_write_spool_replays_after_outage(self):
+        path = self._spool_path()
+        with ContextBrokerClient('127.0.0.1', '1') as down:
+            with down.write_spool(path, retry_interval=60) as spool:
+                spool.create("TestSpool", "test_spool_replay", {"number": 0, "state": "off"})
+                for value in range(1, 6):
+                    self.assertTrue(spool.update_value("TestSpool", "test_spool_replay", "number", value))
+                stats = spool.stats()
+                self.assertEqual(6, stats.get('pending'))
+                self.assertEqual(6, stats.get('spooled'))
+                self.assertGreaterEqual(stats.get('lag'), 0)
+                self.assertRaises(requests.exceptions.ConnectionError, spool.replay)
+                self.assertEqual(6, spool.stats().get('pending'))
+
+        # Spooled writes survive the process, the next spool on the path replays them
+        with self.cbc.write_spool(path, retry_interval=60, max_rate=1000) as spool:
+            self.assertEqual(6, spool.stats().get('pending'))
+            self.assertEqual(1, spool.replay())
+            stats = spool.stats()
+        self.assertEqual(0, stats.get('pending'))
+        self.assertEqual(0, stats.get('size'))
+        self.assertEqual(5, stats.get('coalesced'))
+        self.assertEqual(1, stats.get('replayed'))
+        self.assertEqual(0.0, stats.get('lag'))
+        self.assertEqual('5', self.cbc.attribute.get_value("TestSpool", "test_spool_replay", "number"))
+        self.assertEqual('off', self.cbc.attribute.get_value("TestSpool", "test_spool_replay", "state"))
+
+    def test_write_spool_keeps_order_of_racing_writes(self):
+        batch = self.cbc.batch
+        held = {1: threading.Event(), 2: threading.Event()}
+
+        class RacingBatch(object):
+            def update(self, updates, action, timeout=None):
+                value = updates[0][2][0]["value"]
+                if value in held:
+                    held[value].wait(5)
+                    if value == 1:
+                        raise requests.exceptions.ConnectionError("broker went away")
+                return batch.update(updates, action, timeout)
+
+        key = ("TestSpool", "test_spool_race", "number")
+        with WriteSpool(RacingBatch(), self._spool_path(), retry_interval=60) as spool:
+            first = threading.Thread(target=spool.update_value, args=key + (1,))
+            first.start()
+            time.sleep(0.1)
+            second = threading.Thread(target=spool.update_value, args=key + (2,))
+            second.start()
+            time.sleep(0.1)
+            # The older write fails while the newer one is still being sent directly
+            held[1].set()
+            first.join()
+            held[2].set()
+            second.join()
+            self.assertEqual('2', self.cbc.attribute.get_value(*key))
+            spool.replay()
+        self.assertEqual('2', self.cbc.attribute.get_value(*key))
+
+    def test_write_spool_compacts_and_drops_when_full(self):
+        with ContextBrokerClient('127.0.0.1', '1') as down:
+            with down.write_spool(self._spool_path(), max_size=1000, retry_interval=60) as spool:
+                # Once full the log is compacted down to the last value, which makes room for more writes
+                written = [spool.update_value("TestSpool", "test_spool_full", "number", value) for value in range(20)]
+                self.assertNotIn(False, written)
+                self.assertGreaterEqual(spool.stats().get('compactions'), 1)
+                self.assertGreater(spool.stats().get('coalesced'), 0)
+
+                # Writes to distinct entities can't be compacted away
+                written = [spool.update_value("TestSpool", "test_spool_full_{}".format(i), "number", i)
+                           for i in range(20)]
+                stats = spool.stats()
+        self.assertIn(False, written)
+        self.assertEqual(written.count(False), stats.get('dropped'))
+        self.assertLessEqual(stats.get('size'), 1000)
+
+    def test_write_spool_recovers_truncated_log(self):
+        path = self._spool_path()
+        with ContextBrokerClient('127.0.0.1', '1') as down:
+            with down.write_spool(path, retry_interval=60) as spool:
+                spool.update_value("TestSpool", "test_spool_crash", "number", 1)
+        with open(path, 'ab') as log:
+            log.write(b'{"type": "TestSpool", "id": "test_sp')
+        with self.cbc.write_spool(path, retry_interval=60) as spool:
+            self.assertEqual(1, spool.stats().get('pending'))
+            self.assertEqual(1, spool.replay())
+        self.assertEqual('1', self.cbc.attribute.get_value("TestSpool", "test_spool_crash", "number"))
+
+    # Resilience
+    def test_resilience_retries_idempotent_requests(self):
+        policy = ResiliencePolicy(retries=2, backoff=0)
+        calls = []
+
+        def send(method, url, data, operation, **kwargs):
+            calls.append(method)
+            if len(calls) < 3:
+                raise requests.exceptions.ConnectionError()
+            return 200, 'ok'
+
+        self.assertEqual('ok', policy.call(send, 'GET', 'http://broker', operation='entity.get'))
+        self.assertEqual(3, len(calls))
+        self.assertEqual(2, policy.stats()['retries'])
+
+        del calls[:]
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            policy.call(send, 'POST', 'http://broker', operation='entity.create')
+        self.assertEqual(1, len(calls))
+
+    def test_resilience_retries_unavailable_status(self):
+        policy = ResiliencePolicy(retries=1, backoff=0)
+        statuses = [503, 200]
+        result = policy.call(lambda *args, **kwargs: (statuses.pop(0), 'done'), 'PUT', 'http://broker')
+        self.assertEqual('done', result)
+        self.assertEqual([], statuses)
+
+    def test_resilience_operation_timeouts(self):
+        policy = ResiliencePolicy(timeouts={'entity.get': 0.5})
+        seen = []
+        send = lambda method, url, data, operation, **kwargs: (seen.append(kwargs.get('timeout')), (200, None))[1]
+        policy.call(send, 'GET', 'http://broker', operation='entity.get')
+        policy.call(send, 'GET', 'http://broker', operation='entity.get', timeout=2)
+        policy.call(send, 'GET', 'http://broker', operation='attribute.get')
+        self.assertEqual([0.5, 2, None], seen)
+
+    def test_resilience_circuit_breaker(self):
+        policy = ResiliencePolicy(retries=0, failure_threshold=2, reset_timeout=0.1)
+        failing = lambda *args, **kwargs: (500, None)
+        policy.call(failing, 'GET', 'http://broker')
+        policy.call(failing, 'GET', 'http://broker')
+        self.assertEqual('open', policy.stats()['circuit'])
+        with self.assertRaises(CircuitOpenError):
+            policy.call(failing, 'GET', 'http://broker')
+
+        time.sleep(0.15)
+        self.assertEqual('ok', policy.call(lambda *args, **kwargs: (200, 'ok'), 'GET', 'http://broker'))
+        self.assertEqual('closed', policy.stats()['circuit'])
+        self.assertEqual(1, policy.stats()['short_circuited'])
+
+    def test_resilience_hedged_reads(self):
+        policy = ResiliencePolicy(hedge_percentile=0.9, hedge_min_samples=5)
+        delays = [0] * 5 + [1, 0]
+
+        def send(method, url, data, operation, **kwargs):
+            time.sleep(delays.pop(0))
+            return 200, 'ok'
+
+        for _ in range(5):
+            policy.call(send, 'GET', 'http://broker')
+        started = time.monotonic()
+        self.assertEqual('ok', policy.call(send, 'GET', 'http://broker'))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(1, policy.stats()['hedged'])
+        self.assertEqual(1, policy.stats()['hedge_wins'])
+        policy.close()
+
+    def test_resilience_closes_discarded_responses(self):
+        class Response(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        policy = ResiliencePolicy(hedge_percentile=0.9, hedge_min_samples=5, backoff=0)
+        delays = [0] * 5 + [0.3, 0]
+        responses = []
+
+        def send(method, url, data, operation, **kwargs):
+            time.sleep(delays.pop(0))
+            response = Response()
+            responses.append(response)
+            return 200, response
+
+        for _ in range(5):
+            policy.call(send, 'GET', 'http://broker')
+        winner = policy.call(send, 'GET', 'http://broker')
+        time.sleep(0.5)
+        # The slower answer of a hedged read is closed once it arrives, so its connection goes back to the pool
+        self.assertTrue(responses[-1].closed)
+        self.assertFalse(winner.closed)
+
+        # Streamed requests are not hedged, and a response answered with a retried status is closed
+        statuses = [503, 200]
+        delays[:] = [0.3, 0]
+
+        def send_status(method, url, data, operation, **kwargs):
+            time.sleep(delays.pop(0))
+            response = Response()
+            responses.append(response)
+            return statuses.pop(0), response
+
+        result = policy.call(send_status, 'GET', 'http://broker', hedge=False, stream=True)
+        self.assertTrue(responses[-2].closed)
+        self.assertFalse(result.closed)
+        self.assertEqual(1, policy.stats()['hedged'])
+        policy.close()
+
+    def test_client_with_resilience(self):
+        with ContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT, resilience=ResiliencePolicy()) as cbc:
+            cbc.entity.create("TestSearch", "test_search_resilience")
+            response = cbc.entity.get("TestSearch", "test_search_resilience")
+            self.assertEqual('200', response.get('statusCode').get('code'))
+            cbc.entity.delete("TestSearch", "test_search_resilience")
+
+    # Routing
+    def test_router_fails_over_to_healthy_node(self):
+        # Nothing listens on port 1, requests move on to the working node
+        with ContextBrokerClient('127.0.0.1', '1', nodes=[(CONTEXTBROKER_IP, CONTEXTBROKER_PORT)],
+                                 health_interval=None) as cbc:
+            for _ in range(3):
+                self.assertIsNotNone(cbc.get_version_data(refresh=True))
+            stats = dict((node['address'], node) for node in cbc.router.stats())
+            # The dead node is tried at most once, then skipped until retry_after
+            self.assertLessEqual(stats['http://127.0.0.1:1']['failures'], 1)
+            self.assertEqual(3, stats['http://{}:{}'.format(CONTEXTBROKER_IP, CONTEXTBROKER_PORT)]['requests'])
+
+        router = ContextBrokerRouter(['a:1', 'b:2'], health_interval=None)
+        router.nodes[1].outstanding = 1
+
+        def send(method, url, data, operation):
+            if url.startswith('http://a:1'):
+                raise requests.exceptions.ConnectionError()
+            return url
+
+        self.assertEqual('http://b:2/version', router.send(send, 'GET', 'http://a:1/version',
+                                                           errors=requests.exceptions.ConnectionError))
+        self.assertFalse(router.nodes[0].healthy)
+
+    def test_router_does_not_resend_timed_out_writes(self):
+        with FakeOrionServer(latency=1.0) as slow, FakeOrionServer() as fast:
+            with ContextBrokerClient(slow.ip, slow.port, nodes=[(fast.ip, fast.port)], timeout=0.3,
+                                     health_interval=None) as cbc:
+                # The slow node is tried first
+                cbc.router.nodes[1].outstanding = 1
+                self.assertRaises(requests.exceptions.ReadTimeout, cbc.subscription.on_change,
+                                  "TestRouter", "test_router_1", "number", "http://localhost:1/notify")
+                # The slow node did get the subscription, it is not created a second time on the other one
+                self.assertEqual(0, len(fast.store.subscriptions))
+                time.sleep(1.0)
+                self.assertEqual(1, len(slow.store.subscriptions))
+
+                # Reads are safe to send again
+                cbc.router.mark_up(cbc.router.nodes[0])
+                self.assertIsNotNone(cbc.get_version_data(refresh=True).get('orion'))
+
+        # A refused connection never sent the request, so even a POST may go to the next node
+        with self.assertRaises(requests.exceptions.ConnectionError) as refused:
+            requests.post('http://127.0.0.1:1/v1/subscribeContext')
+        self.assertTrue(request_unsent(refused.exception))
+
+    def test_router_least_outstanding(self):
+        router = ContextBrokerRouter(['a:1', 'b:2'], health_interval=None)
+        router.nodes[0].outstanding = 3
+        self.assertEqual('http://b:2', router.candidates('GET')[0].address)
+        self.assertEqual('http://b:2/v1/contextEntities', router.rewrite('http://a:1/v1/contextEntities', router.nodes[1]))
+
+    def test_router_pins_writes(self):
+        router = ContextBrokerRouter(['a:1', 'b:2', 'c:3'], pin_writes=True, health_interval=None)
+        owners = set(router.candidates('POST', ('Room', 'room_1'))[0].address for _ in range(10))
+        self.assertEqual(1, len(owners))
+        spread = set(router.candidates('POST', ('Room', 'room_{}'.format(i)))[0].address for i in range(50))
+        self.assertEqual(3, len(spread))
+
+        owner = [node for node in router.nodes if node.address in owners][0]
+        router.mark_down(owner)
+        self.assertNotEqual(owner, router.candidates('POST', ('Room', 'room_1'))[0])
+
     # Subscription
     def test_get_all_subscriptions(self):
         self.test_create_subscription_on_attribute_change()
@@ -219,11 +905,136 @@ class PycontextbrokerTestCase(unittest.TestCase):
         self.assertIn('throttling', response['subscribeResponse'])
         self.assertIn('duration', response['subscribeResponse'])
 
+    def test_notification_listener(self):
+        received = []
+        done = threading.Event()
+
+        def on_update(update):
+            received.append(update)
+            if len(received) == 2:
+                done.set()
+
+        with NotificationListener(host='127.0.0.1') as listener:
+            listener.on_notification(on_update, entity_type="TestSearch")
+            response = listener.subscribe(self.cbc.subscription, "TestSearch", "test_search_1", "number")
+            self.assertIn('subscribeResponse', response)
+            notification = {
+                "subscriptionId": response['subscribeResponse']['subscriptionId'],
+                "contextResponses": [
+                    {"contextElement": {"type": "TestSearch", "isPattern": "false", "id": "test_search_1",
+                                        "attributes": [{"name": "number", "type": "integer", "value": "7"}]},
+                     "statusCode": {"code": "200", "reasonPhrase": "OK"}},
+                    {"contextElement": {"type": "Other", "isPattern": "false", "id": "other_1"},
+                     "statusCode": {"code": "200", "reasonPhrase": "OK"}},
+                ]
+            }
+            requests.post(listener.url, data=json.dumps(notification))
+            requests.post(listener.url, data=json.dumps(
+                {"subscriptionId": "v2", "data": [{"id": "test_search_1", "type": "TestSearch", "number": {"type": "Number", "value": 8, "metadata": {}}}]}
+            ))
+            self.assertTrue(done.wait(5))
+
+        self.assertEqual('7', received[0].get('attributes')[0].get('value'))
+        self.assertEqual(8, received[1].get('attributes')[0].get('value'))
+        self.assertEqual(3, listener.stats().get('received'))
+        self.assertEqual(0, listener.stats().get('rejected'))
+
+    def test_notification_listener_rejects_whole_notifications(self):
+        # No workers, so nothing leaves the queue of one notification
+        with NotificationListener(host='127.0.0.1', workers=0, queue_size=1, put_timeout=0.05) as listener:
+            updates = [{"type": "TestSearch", "id": "test_search_{}".format(i), "attributes": []} for i in range(3)]
+            self.assertTrue(listener.enqueue(updates))
+            self.assertFalse(listener.enqueue(updates[:2]))
+            self.assertEqual(1, listener.stats().get('queue_depth'))
+            self.assertEqual(2, listener.stats().get('rejected'))
+
+            self.assertEqual(400, requests.post(listener.url, data='[1, 2]').status_code)
+            self.assertEqual(400, requests.post(listener.url, data='not json').status_code)
+
     def test_unsubscribe_no_subcription_with_such_id(self):
         response = self.cbc.subscription.unsubscribe("###")
         self.assertEqual(response.get('statusCode').get('code'), '400')
         self.assertEqual(response.get('statusCode').get('reasonPhrase'), 'Bad Request')
 
+    def test_subscription_duration_and_throttling(self):
+        response = self.cbc.subscription.on_change("TestSearch", "test_search_1", "number", "http://localhost:3030/cb",
+                                                   duration="PT1H", throttling="PT1S")
+        subscription_id = response['subscribeResponse']['subscriptionId']
+        self.assertEqual("PT1H", response['subscribeResponse']['duration'])
+        response = self.cbc.subscription.update(subscription_id, duration="P1D")
+        self.assertEqual(subscription_id, response['subscribeResponse']['subscriptionId'])
+        self.cbc.subscription.unsubscribe(subscription_id)
+
+    def test_pattern_and_bulk_subscriptions(self):
+        pattern = self.cbc.subscription.on_type_change("TestPattern", ["number"], "http://localhost:3030/cb")
+        entities = [("TestBulk", "test_bulk_{}".format(i)) for i in range(5)]
+        bulk = self.cbc.subscription.on_change_many(entities, "number", "http://localhost:3030/cb", chunk_size=2)
+        self.assertEqual(3, len(bulk))
+        subscription_ids = [r['subscribeResponse']['subscriptionId'] for r in [pattern] + bulk]
+        subscriptions = dict((s['id'], s) for s in self.cbc.subscription.iter(page_size=2))
+        self.assertEqual('.*', subscriptions[subscription_ids[0]]['subject']['entities'][0]['idPattern'])
+        self.assertEqual(2, len(subscriptions[subscription_ids[1]]['subject']['entities']))
+        for subscription_id in subscription_ids:
+            self.cbc.subscription.unsubscribe(subscription_id)
+
+    def test_subscription_registry_deduplicates(self):
+        with SubscriptionRegistry(self.cbc.subscription, renew_interval=None) as registry:
+            first = registry.on_change("TestRegistry", "test_registry_1", "number", "http://localhost:3030/cb")
+            self.assertEqual(first, registry.on_change("TestRegistry", "test_registry_1", "number",
+                                                       "http://localhost:3030/cb"))
+            wide = registry.on_type_change("TestRegistry", ["number", "temperature"], "http://localhost:3030/cb")
+            self.assertEqual(wide, registry.on_change("TestRegistry", "test_registry_2", "temperature",
+                                                      "http://localhost:3030/cb"))
+            entities = [("TestRegistry", "test_registry_3"), ("TestOther", "test_other_1"), ("TestOther", "test_other_1")]
+            self.assertEqual(1, len(registry.on_change_many(entities, "number", "http://localhost:3030/cb")))
+            self.assertEqual({"subscriptions": 3, "deduplicated": 4, "renewed": 0, "failed": 0}, registry.stats())
+            registry.close(unsubscribe=True)
+            self.assertEqual(0, len(registry))
+
+    def test_subscription_registry_renews(self):
+        self.assertEqual(2592000, parse_duration("P1M"))
+        self.assertEqual(90, parse_duration("PT1M30S"))
+        with SubscriptionRegistry(self.cbc.subscription, duration="PT10S", renew_before=60,
+                                  renew_interval=None) as registry:
+            subscription_id = registry.on_change("TestRegistry", "test_registry_renew", "number",
+                                                 "http://localhost:3030/cb")
+            self.assertEqual(1, registry.renew())
+            # Gone from the broker: renewing subscribes again
+            self.cbc.subscription.unsubscribe(subscription_id)
+            self.assertEqual(1, registry.renew())
+            self.assertNotIn(subscription_id, registry.registrations)
+            self.assertEqual(2, registry.stats()["renewed"])
+            registry.close(unsubscribe=True)
+
+    def test_subscription_registry_renews_without_blocking(self):
+        subscription = self.cbc.subscription
+        renewing, release = threading.Event(), threading.Event()
+
+        class SlowRenewals(object):
+            def __getattr__(self, name):
+                return getattr(subscription, name)
+
+            def update(self, *args, **kwargs):
+                renewing.set()
+                release.wait(5)
+                return subscription.update(*args, **kwargs)
+
+        with SubscriptionRegistry(SlowRenewals(), renew_interval=None) as registry:
+            first = registry.on_change("TestRegistry", "test_registry_slow_1", "number", "http://localhost:3030/cb")
+            renewal = threading.Thread(target=registry.renew, kwargs={"force": True})
+            renewal.start()
+            self.assertTrue(renewing.wait(5))
+            # The renewal is waiting on the broker, lookups and new subscriptions go ahead
+            self.assertEqual(first, registry.on_change("TestRegistry", "test_registry_slow_1", "number",
+                                                       "http://localhost:3030/cb"))
+            self.assertIsNotNone(registry.on_change("TestRegistry", "test_registry_slow_2", "number",
+                                                    "http://localhost:3030/cb"))
+            self.assertEqual(0, registry.stats()["renewed"])
+            release.set()
+            renewal.join()
+            self.assertEqual(1, registry.stats()["renewed"])
+            registry.close(unsubscribe=True)
+
     def test_unsubscribe(self):
         subscriptions = self.cbc.subscription.all()
         initial_num_subsciptions = len(subscriptions)
@@ -237,5 +1048,119 @@ class PycontextbrokerTestCase(unittest.TestCase):
         final_num_subscriptions = len(self.cbc.subscription.all())
         self.assertEqual(initial_num_subsciptions, final_num_subscriptions + 1)
 
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class AsyncPycontextbrokerTestCase(unittest.TestCase):
+
+    def run_async(self, coroutine_function):
+        async def run():
+            async with AsyncContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT) as cbc:
+                return await coroutine_function(cbc)
+        return asyncio.run(run())
+
+    def test_get_version(self):
+        self.assertIsNotNone(self.run_async(lambda cbc: cbc.get_version()))
+
+    def test_health_check(self):
+        self.assertTrue(self.run_async(lambda cbc: cbc.health_check()))
+
+    def test_entity_and_attribute(self):
+        async def scenario(cbc):
+            await cbc.entity.create("TestSearch", "test_search_async", attributes=[{"name": "number", "type": "integer", "value": "1"}])
+            await cbc.attribute.update_value("TestSearch", "test_search_async", "number", 2)
+            values = await asyncio.gather(*[cbc.attribute.get_value("TestSearch", "test_search_async", "number") for _ in range(20)])
+            entity = await cbc.entity.get("TestSearch", "test_search_async")
+            await cbc.entity.delete("TestSearch", "test_search_async")
+            return values, entity
+        values, entity = self.run_async(scenario)
+        self.assertEqual(['2'] * 20, values)
+        self.assertEqual('test_search_async', entity.get('contextElement').get('id'))
+
+    def test_iter_entities(self):
+        async def scenario(cbc):
+            await cbc.batch.update(("TestIterAsync", "test_iter_{}".format(i), {"number": i}) for i in range(5))
+            return [entity async for entity in cbc.entity.iter(entity_type="TestIterAsync", page_size=2)]
+        self.assertEqual(5, len(self.run_async(scenario)))
+
+    def test_iter_entities_filtered(self):
+        async def scenario(cbc):
+            await cbc.batch.update(("TestFilterAsync", "test_filter_{}".format(i), {"number": i}) for i in range(4))
+            entities = [entity async for entity in cbc.entity.iter(entity_type="TestFilterAsync", q="number<2",
+                                                                   options="keyValues")]
+            entity = await cbc.entity.get_entity("TestFilterAsync", "test_filter_3", attrs=["number"])
+            return entities, entity
+        entities, entity = self.run_async(scenario)
+        self.assertEqual([0, 1], [e["number"] for e in entities])
+        self.assertEqual(3, entity.get_value("number"))
+
+    def test_streamed_listings(self):
+        async def scenario(cbc):
+            await cbc.batch.update(("TestStreamAsync", "test_stream_{}".format(i), {"number": i}) for i in range(5))
+            streamed = [e async for e in cbc.entity.iter(entity_type="TestStreamAsync", page_size=2, stream=True)]
+            subscriptions = [s async for s in await cbc.subscription.all(stream=True)]
+            return streamed, subscriptions, await cbc.subscription.all()
+        streamed, subscriptions, expected = self.run_async(scenario)
+        self.assertEqual(['test_stream_{}'.format(i) for i in range(5)], [e['id'] for e in streamed])
+        self.assertEqual(expected, subscriptions)
+
+    def test_streamed_listings_fail_over(self):
+        async def scenario():
+            # Nothing listens on port 1, the stream is opened on the working node instead
+            async with AsyncContextBrokerClient('127.0.0.1', '1', nodes=[(CONTEXTBROKER_IP, CONTEXTBROKER_PORT)],
+                                                health_interval=None) as cbc:
+                cbc.router.nodes[1].outstanding = 1
+                subscriptions = [s async for s in await cbc.subscription.all(stream=True)]
+                cbc.router.nodes[1].outstanding = 0
+                return subscriptions, await cbc.subscription.all()
+        subscriptions, expected = asyncio.run(scenario())
+        self.assertEqual(expected, subscriptions)
+
+    def test_batch_update(self):
+        updates = [("TestBatch", "test_batch_async_{}".format(i), {"number": i}) for i in range(3)]
+        response = self.run_async(lambda cbc: cbc.batch.update(updates))
+        self.assertEqual(['200'] * 3, [r.get('statusCode').get('code') for r in response])
+
+    def test_batch_update_timeout(self):
+        async def scenario():
+            async with AsyncContextBrokerClient(slow.ip, slow.port) as cbc:
+                updates = [("TestBatch", "test_batch_async_timeout", {"number": 1})]
+                with self.assertRaises(asyncio.TimeoutError):
+                    await cbc.batch.update(updates, timeout=0.2)
+                return await cbc.batch.update(updates, 'APPEND', 5)
+        with FakeOrionServer(latency=0.5) as slow:
+            response = asyncio.run(scenario())
+        self.assertEqual('200', response[0]['statusCode']['code'])
+
+    def test_resilience_retries(self):
+        policy = ResiliencePolicy(retries=1, backoff=0)
+        statuses = [503, 200]
+
+        async def send(method, url, data, operation, **kwargs):
+            return statuses.pop(0), 'done'
+
+        self.assertEqual('done', asyncio.run(policy.acall(send, 'GET', 'http://broker')))
+        self.assertEqual(1, policy.stats()['retries'])
+
+    def test_subscriptions(self):
+        async def scenario(cbc):
+            responses = await cbc.subscription.on_change_many(
+                [("TestBulk", "test_bulk_async_{}".format(i)) for i in range(3)], "number", "http://localhost:3030/cb"
+            )
+            subscription_ids = [r['subscribeResponse']['subscriptionId'] for r in responses]
+            listed = [s['id'] async for s in cbc.subscription.iter(page_size=1)]
+            for subscription_id in subscription_ids:
+                await cbc.subscription.unsubscribe(subscription_id)
+            return subscription_ids, listed
+        subscription_ids, listed = self.run_async(scenario)
+        self.assertEqual(1, len(subscription_ids))
+        self.assertIn(subscription_ids[0], listed)
+
+    def test_client_with_resilience(self):
+        async def scenario():
+            async with AsyncContextBrokerClient(CONTEXTBROKER_IP, CONTEXTBROKER_PORT,
+                                                resilience=ResiliencePolicy(timeouts={'version': 1})) as cbc:
+                return await cbc.get_version()
+        self.assertIsNotNone(asyncio.run(scenario()))
+
 if __name__ == '__main__':
     unittest.main()